@@ -0,0 +1,34 @@
+import os
+import hashlib
+import sqlite3
+from typing import Sequence
+
+# Shared by the viewer's render cache and the RAG system's indexes and embeddings
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "res_reader")
+
+def hash_file(path: str, block_size: int = 1024 * 1024) -> str:
+    """Hash a file's contents so cache entries follow the document, not its path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def evict_lru(conn: sqlite3.Connection, table: str, key_columns: Sequence[str], size_expr: str,
+              total_bytes: int, max_bytes: int) -> int:
+    """Delete a table's least recently used rows until it is back under 90% of max_bytes.
+
+    The table needs a last_used column; size_expr gives a row's size in bytes.
+    Returns the new total. The caller holds its lock and commits.
+    """
+    target = max_bytes * 0.9
+    match = " AND ".join(f"{column}=?" for column in key_columns)
+    rows = conn.execute(
+        f"SELECT {', '.join(key_columns)}, {size_expr} FROM {table} ORDER BY last_used"
+    ).fetchall()
+    for *key, size in rows:
+        if total_bytes <= target:
+            break
+        conn.execute(f"DELETE FROM {table} WHERE {match}", key)
+        total_bytes -= size
+    return total_bytes
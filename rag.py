@@ -1,6 +1,23 @@
 import os
+import re
+import json
+import pickle
+import math
+import time
+import random
+import sqlite3
+import hashlib
+import zlib
 import tempfile
-from typing import List, Dict, Any
+import queue
+import asyncio
+import threading
+import itertools
+import functools
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict, Any, Callable, Iterable, Iterator, AsyncIterator, Tuple
 
 # PDF processing
 from PyPDF2 import PdfReader
@@ -11,79 +28,1352 @@ import numpy as np
 # Replace the incorrect import
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 # LLM 
 import google.generativeai as genai
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+# Cache root, file hashing and LRU eviction shared with the viewer
+from cache_utils import DEFAULT_CACHE_DIR, hash_file, evict_lru
+
+# Saved vector stores live here, one sub-directory per document and config
+DEFAULT_INDEX_DIR = os.path.join(DEFAULT_CACHE_DIR, "indexes")
+
+# Embeddings of individual chunks, shared by every document
+DEFAULT_EMBEDDING_CACHE = os.path.join(DEFAULT_CACHE_DIR, "embeddings.sqlite3")
+
+PDF_BACKENDS = ("pypdf2", "pymupdf")
+
+# Only PyMuPDF reports where text sits on the page, which chunks need to point
+# back at their source; the viewer requires it anyway
+DEFAULT_PDF_BACKEND = "pymupdf" if importlib.util.find_spec("pymupdf") else "pypdf2"
+
+# FAISS index_factory strings for the corpus index; any other factory string works too.
+# {nlist} and {m} are filled in from the training sample size and the dimension.
+INDEX_TYPES = {
+    "flat": "Flat",                # Exact search over float32 vectors
+    "fp16": "SQfp16",              # Exact search over float16 vectors, half the memory
+    "sq8": "SQ8",                  # 8-bit scalar quantization, a quarter of the memory
+    "hnsw": "HNSW32",              # Graph index: fast approximate search, more memory
+    "ivf": "IVF{nlist},Flat",      # Searches only the nprobe nearest of nlist clusters
+    "ivfpq": "IVF{nlist},PQ{m}",   # IVF over product-quantized codes of m bytes
+}
+
+def training_vectors_needed(index) -> int:
+    """Fewest training vectors a FAISS index accepts: one per IVF cluster or PQ centroid."""
+    import faiss
+    needed = 1
+    quantized = faiss.downcast_index(index)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        needed = ivf.nlist
+        quantized = faiss.downcast_index(ivf)
+    except RuntimeError:
+        pass  # Not an IVF index
+    if hasattr(quantized, "pq"):
+        needed = max(needed, quantized.pq.ksub)
+    return needed
+
+def count_pages(pdf_path: str, backend: str = "pypdf2") -> int:
+    """Number of pages in a PDF."""
+    if backend == "pymupdf":
+        import pymupdf
+        with pymupdf.open(pdf_path) as doc:
+            return doc.page_count
+    return len(PdfReader(pdf_path).pages)
+
+def extract_page_texts(pdf_path: str, start: int = 0, stop: int = None,
+                       backend: str = "pypdf2") -> List[str]:
+    """Extract the text of pages [start, stop) of a PDF, one string per page.
+    
+    Module-level so it can run in a worker process; each call opens the file itself.
+    """
+    if backend == "pymupdf":
+        import pymupdf  # Much faster than PyPDF2; the viewer depends on it already
+        with pymupdf.open(pdf_path) as doc:
+            stop = doc.page_count if stop is None else stop
+            return [doc[i].get_text() for i in range(start, stop)]
+    pages = PdfReader(pdf_path).pages
+    stop = len(pages) if stop is None else stop
+    return [pages[i].extract_text() for i in range(start, stop)]
+
+def extract_page_blocks(pdf_path: str, start: int = 0, stop: int = None,
+                        backend: str = "pypdf2") -> List[List[tuple]]:
+    """Extract pages [start, stop) of a PDF as lists of (text, bbox) text blocks.
+    
+    With PyMuPDF a block is a paragraph-like region and bbox is its
+    (x0, y0, x1, y1) in PDF points. PyPDF2 has no layout information, so each
+    page is a single block with a bbox of None.
+    """
+    if backend == "pymupdf":
+        import pymupdf
+        with pymupdf.open(pdf_path) as doc:
+            stop = doc.page_count if stop is None else stop
+            return [
+                [(block[4], tuple(round(v, 1) for v in block[:4]))
+                 for block in doc[i].get_text("blocks") if block[6] == 0]  # Skip images
+                for i in range(start, stop)
+            ]
+    return [[(text, None)] for text in extract_page_texts(pdf_path, start, stop, backend)]
+
+class EmbeddingCache:
+    """On-disk key-value store of float32 embedding vectors with LRU size eviction."""
+    
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY, vector BLOB, last_used REAL
+            )"""
+        )
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+    
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """Cache key for a text embedded with a given model."""
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+    
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached vectors for whichever keys are present."""
+        found = {}
+        with self.lock:
+            # Stay below SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                self.conn.execute(
+                    f"UPDATE embeddings SET last_used=? WHERE key IN ({placeholders})",
+                    [time.time()] + batch
+                )
+            self.conn.commit()
+        return found
+    
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        """Store vectors, evicting the least recently used ones over the size cap."""
+        now = time.time()
+        with self.lock:
+            for key, vector in items.items():
+                blob = np.asarray(vector, dtype=np.float32).tobytes()
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?)", (key, blob, now)
+                )
+                self.total_bytes += len(blob) * cursor.rowcount
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+    
+    def evict(self) -> None:
+        """Delete the least recently used vectors to make room."""
+        self.total_bytes = evict_lru(
+            self.conn, "embeddings", ("key",), "LENGTH(vector)", self.total_bytes, self.max_bytes
+        )
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends chunks missing from an EmbeddingCache to the model."""
+    
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, reusing cached vectors for byte-identical chunks."""
+        keys = [EmbeddingCache.make_key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        
+        # Embed each missing text once, even if it repeats within the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            cached = sum(1 for key in keys if key in vectors)
+            print(f"Embedding {len(missing)} new chunks ({cached} cached)...")
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, new_vectors)}
+            self.cache.put_many(new_items)
+            vectors.update(new_items)
+        
+        return [vectors[key].tolist() for key in keys]
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query; queries are not cached here."""
+        return self.embeddings.embed_query(text)
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how many requests start per second."""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a request may start."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = max(self.paused_until - now, (1.0 - self.tokens) / self.rate)
+            time.sleep(wait)
+    
+    def pause(self, seconds: float) -> None:
+        """Stop every caller from starting requests for a while (server pushback)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+class EmbeddingPipelineError(RuntimeError):
+    """Raised when a batch still fails after all retries; completed batches are kept."""
+    
+    def __init__(self, message: str, completed: int, total: int):
+        super().__init__(message)
+        self.completed = completed
+        self.total = total
+
+class EmbeddingPipeline(Embeddings):
+    """Embeds documents in batches on a bounded pool of in-flight requests.
+    
+    Request starts are rate limited by a token bucket, failed batches are
+    retried with exponential backoff, and rate-limit errors pause every worker.
+    If a call still fails, the batches that did finish are remembered, and
+    calling again with the same texts resumes from them.
+    """
+    
+    def __init__(self, embeddings: Embeddings, batch_size: int = 64, max_in_flight: int = 4,
+                 requests_per_second: float = 5.0, max_retries: int = 5, backoff: float = 1.0):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.completed_batches = {}  # Hash of a batch's texts -> its vectors, kept for resuming
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def is_rate_limit_error(error: Exception) -> bool:
+        """Guess whether an error is the server asking us to slow down."""
+        text = f"{type(error).__name__} {error}".lower()
+        return any(marker in text for marker in ("429", "resourceexhausted", "rate limit", "quota"))
+    
+    def call_with_retry(self, func: Callable[[], Any]) -> Any:
+        """Run one rate-limited request, retrying with exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                return func()
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                if self.is_rate_limit_error(e):
+                    # Back off as a group, not just this worker
+                    self.rate_limiter.pause(delay)
+                print(f"Embedding request failed ({e}); retrying in {delay:.1f}s...")
+                time.sleep(delay)
+    
+    def embed_batch(self, key: str, batch: List[str]) -> List[List[float]]:
+        """Embed one batch, unless an earlier interrupted call already did."""
+        with self.lock:
+            if key in self.completed_batches:
+                return self.completed_batches[key]
+        vectors = self.call_with_retry(lambda: self.embeddings.embed_documents(batch))
+        with self.lock:
+            self.completed_batches[key] = vectors
+        return vectors
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in order, batch_size at a time, max_in_flight batches at once."""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        keys = [hashlib.sha256("\0".join(batch).encode("utf-8")).hexdigest() for batch in batches]
+        
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = [executor.submit(self.embed_batch, key, batch) for key, batch in zip(keys, batches)]
+            results = []
+            for i, future in enumerate(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    # Let the remaining in-flight batches finish so a retry can reuse them
+                    for other in futures[i + 1:]:
+                        other.exception()
+                    completed = sum(1 for key in keys if key in self.completed_batches)
+                    raise EmbeddingPipelineError(
+                        f"Embedding failed after {completed}/{len(batches)} batches: {e}",
+                        completed, len(batches)
+                    ) from e
+                if len(batches) > 1:
+                    print(f"Embedded batch {i + 1}/{len(batches)}")
+        
+        # Everything succeeded, so there is nothing left to resume
+        with self.lock:
+            for key in keys:
+                self.completed_batches.pop(key, None)
+        return results
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query through the same rate limiter and retry policy."""
+        return self.call_with_retry(lambda: self.embeddings.embed_query(text))
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, keeping numbers and identifiers like 'l2' or 'eq_3'."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+@functools.lru_cache(maxsize=1 << 18)
+def hash_bucket(token: str, dimension: int) -> int:
+    """Stable (unlike hash()) signed bucket of a token: +(i + 1) or -(i + 1).
+    
+    Memoized, since crc32 per token dominates embedding otherwise; the bound
+    keeps a long-running ingest of an open vocabulary from growing without limit.
+    """
+    h = zlib.crc32(token.encode("utf-8"))
+    return (h % dimension + 1) * (1 if h & 0x80000000 else -1)
+
+class HashingEmbeddings(Embeddings):
+    """Local embeddings from a hashed bag of words and word bigrams.
+    
+    Needs no model or network: tokens are hashed into a fixed number of signed
+    buckets, counts are damped with log1p and vectors are L2-normalized, all in
+    NumPy over the whole batch. Much weaker semantically than a trained model,
+    but it embeds a query in microseconds and works on air-gapped machines.
+    """
+    
+    def __init__(self, dimension: int = 1024):
+        self.dimension = dimension
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        rows, buckets = [], []
+        for row, text in enumerate(texts):
+            words = tokenize(text)
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            rows.extend([row] * len(features))
+            buckets.extend(hash_bucket(feature, self.dimension) for feature in features)
+        
+        buckets = np.asarray(buckets, dtype=np.int64)
+        counts = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(counts, (np.asarray(rows, dtype=np.int64), np.abs(buckets) - 1), np.sign(buckets))
+        vectors = np.sign(counts) * np.log1p(np.abs(counts))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).tolist()
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+EMBEDDING_BACKENDS = ("gemini", "hashing", "sentence-transformers")
+
+class BM25Index:
+    """An in-memory inverted index scoring chunks with Okapi BM25.
+    
+    Rows are numbered in the order they are added, matching the rows of the
+    corpus vector index, so the two can be fused and filtered the same way.
+    """
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> ([row, ...], [term frequency, ...])
+        self.lengths = []  # Number of tokens in each row
+        self.total_length = 0
+    
+    def __len__(self) -> int:
+        return len(self.lengths)
+    
+    def add(self, texts: List[str]) -> None:
+        """Index texts as the next rows."""
+        for text in texts:
+            row = len(self.lengths)
+            tokens = tokenize(text)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, count in counts.items():
+                rows, freqs = self.postings.setdefault(term, ([], []))
+                rows.append(row)
+                freqs.append(count)
+            self.lengths.append(len(tokens))
+            self.total_length += len(tokens)
+    
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every row for a query."""
+        num_rows = len(self.lengths)
+        if num_rows == 0:
+            return np.zeros(0, dtype=np.float32)
+        lengths = np.asarray(self.lengths, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self.total_length / num_rows))
+        
+        scores = np.zeros(num_rows, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            term_rows, freqs = self.postings[term]
+            term_rows = np.asarray(term_rows)
+            freqs = np.asarray(freqs, dtype=np.float32)
+            idf = math.log(1 + (num_rows - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            scores[term_rows] += idf * freqs * (self.k1 + 1) / (freqs + norm[term_rows])
+        return scores
+    
+    def search(self, query: str, k: int, rows: np.ndarray = None) -> List[int]:
+        """The k best-scoring rows for a query, optionally among the given rows only."""
+        scores = self.scores(query)
+        num_rows = len(scores)
+        if rows is not None:
+            allowed = np.zeros(num_rows, dtype=bool)
+            allowed[rows] = True
+            scores[~allowed] = 0
+        
+        # Partial sort: only the top k need ordering
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")].tolist()
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[int]:
+    """Merge ranked lists of rows by summing 1 / (k + rank) across lists."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+RETRIEVAL_MODES = ("hybrid", "vector", "lexical")
+
+RERANKERS = ("lexical", "cross-encoder")
+
+def normalize_question(question: str) -> str:
+    """Fold case, whitespace and trailing punctuation so trivially different repeats match."""
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+class QueryCache:
+    """A thread-safe LRU map whose entries optionally expire after ttl seconds."""
+    
+    def __init__(self, max_entries: int = 1024, ttl: float = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+    
+    def get(self, key: Any) -> Any:
+        """The value stored under key, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+    
+    def put(self, key: Any, value: Any) -> None:
+        """Store a value, evicting the least recently used entries beyond max_entries."""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
 class RAGSystem:
-    def __init__(self, api_key: str):
-        """Initialize the RAG system with the Google Gemini API key."""
+    def __init__(self, api_key: str = None, index_dir: str = DEFAULT_INDEX_DIR,
+                 embedding_cache_path: str = DEFAULT_EMBEDDING_CACHE,
+                 embedding_batch_size: int = 64, max_embedding_requests: int = 4,
+                 embedding_requests_per_second: float = 5.0,
+                 pdf_backend: str = DEFAULT_PDF_BACKEND, extraction_workers: int = None,
+                 index_type: str = "flat", index_train_size: int = 20000,
+                 nprobe: int = 16, ef_search: int = 64, retrieval: str = "hybrid",
+                 answer_cache_ttl: float = 3600.0, llm: Any = None,
+                 embedding_backend: str = "gemini", embedding_model_name: str = None,
+                 embeddings: Embeddings = None, context_token_budget: int = 1500,
+                 mmr_lambda: float = 0.7, reranker: str = None, rerank_candidates: int = 50,
+                 reranker_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+        """Initialize the RAG system with the Google Gemini API key.
+        
+        Vector stores are saved under index_dir and reused when the same PDF is
+        loaded again with the same chunking and embedding settings. Chunk
+        embeddings are cached in embedding_cache_path, so re-ingesting revised
+        or overlapping papers only embeds the new chunks. Pass None for either
+        to disable it. The embedding_* arguments tune how chunks are batched and
+        sent to the embedding API.
+        
+        Text is extracted with pdf_backend ("pypdf2" or "pymupdf") by a pool of
+        extraction_workers processes (one per core by default). Only "pymupdf",
+        the default when it is installed, records the boxes of each chunk's text.
+        
+        index_type picks the corpus index from INDEX_TYPES (or is a FAISS factory
+        string). Types that need training keep an exact index until the corpus
+        holds index_train_size chunks, then train on a sample of them; call
+        train_index to do it sooner. nprobe (IVF) and ef_search (HNSW) trade
+        query latency for recall.
+        
+        retrieval is the default for answer_question: "hybrid" fuses the vector
+        index with a local BM25 index, "vector" and "lexical" use one of them.
+        
+        Query embeddings are cached by normalized question, and retrieved chunks
+        and answers by index version and question for answer_cache_ttl seconds
+        (0 disables the answer cache). Changing the corpus invalidates answers.
+        
+        llm replaces the Gemini chat model with any LangChain chat model, such
+        as a fake one in tests. Without an api_key or llm there is no chat model,
+        and only retrieval is available.
+        
+        embedding_backend is "gemini", or one of the local backends "hashing"
+        (HashingEmbeddings, no dependencies) and "sentence-transformers" (a small
+        model, embedding_model_name, run on the CPU; needs that package), which
+        work offline. embeddings overrides it with any LangChain Embeddings.
+        
+        Retrieved chunks are merged, de-duplicated and packed into
+        context_token_budget tokens before they go into the prompt; mmr_lambda
+        (None to disable) trades relevance against diversity when picking them.
+        
+        reranker ("lexical", or "cross-encoder" with reranker_model, which needs
+        sentence-transformers) re-scores rerank_candidates retrieved chunks on the
+        CPU before the best few are used. Per-stage timings of the last question
+        are in last_timings, and averages over all questions in timing_summary().
+        """
+        if reranker is not None and reranker not in RERANKERS:
+            raise ValueError(f"reranker must be one of {RERANKERS}, not {reranker!r}")
+        if embedding_backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"embedding_backend must be one of {EMBEDDING_BACKENDS}, not {embedding_backend!r}")
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval must be one of {RETRIEVAL_MODES}, not {retrieval!r}")
+        if pdf_backend not in PDF_BACKENDS:
+            raise ValueError(f"pdf_backend must be one of {PDF_BACKENDS}, not {pdf_backend!r}")
         self.api_key = api_key
-        os.environ["GOOGLE_API_KEY"] = api_key
-        genai.configure(api_key=api_key)
+        self.index_dir = index_dir
+        self.pdf_backend = pdf_backend
+        self.extraction_workers = extraction_workers or os.cpu_count() or 1
+        self.pages_per_task = 8  # Smaller documents are extracted in-process
+        # Chunks embedded and indexed at a time: enough for every concurrent
+        # embedding request to get a full batch
+        self.ingest_batch_size = embedding_batch_size * max_embedding_requests
+        self.ingest_queue_size = 2  # Batches waiting for the embedding thread
+        self.extraction_pool = None  # Started on first use
+        self.index_type = index_type
+        self.index_train_size = index_train_size
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.corpus_needs_training = False  # The corpus index is still the exact stand-in
+        self.retrieval = retrieval
+        self.fusion_depth = 20  # Candidates taken from each retriever before fusion
+        self.context_token_budget = context_token_budget
+        self.mmr_lambda = mmr_lambda
+        self.mmr_candidates = 20  # Chunks MMR chooses the k it keeps from
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.reranker_model = reranker_model
+        self.cross_encoder = None  # Loaded on first use
+        self.last_timings = {}  # Stage -> milliseconds, for the last question
+        self.timing_totals = {}  # Stage -> [count, total milliseconds]
+        self.timing_lock = threading.Lock()
+        
+        # Level 1: normalized question -> query embedding (independent of the corpus)
+        self.query_embedding_cache = QueryCache(max_entries=4096)
+        # Level 2: (index version, question, k, ...) -> retrieved rows and answer
+        self.answer_cache = QueryCache(max_entries=1024, ttl=answer_cache_ttl) if answer_cache_ttl else None
+        self.index_version = 0  # Bumped whenever the corpus changes
+        if api_key:
+            os.environ["GOOGLE_API_KEY"] = api_key
+            genai.configure(api_key=api_key)
         
         # Initialize the embedding model
-        self.embedding_model = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=api_key,
-        )
+        if embeddings is not None:
+            self.embedding_model_name = embedding_model_name or type(embeddings).__name__
+            self.embedding_model = embeddings
+        elif embedding_backend == "hashing":
+            # Cheaper to recompute than to look up, so it skips the embedding cache
+            self.embedding_model = HashingEmbeddings()
+            self.embedding_model_name = f"hashing-{self.embedding_model.dimension}"
+            embedding_cache_path = None
+        elif embedding_backend == "sentence-transformers":
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            self.embedding_model_name = embedding_model_name or "sentence-transformers/all-MiniLM-L6-v2"
+            self.embedding_model = HuggingFaceEmbeddings(
+                model_name=self.embedding_model_name,
+                model_kwargs={"device": "cpu"},
+                encode_kwargs={"batch_size": embedding_batch_size, "normalize_embeddings": True},
+            )
+        else:
+            self.embedding_model_name = embedding_model_name or "models/embedding-001"
+            self.embedding_model = GoogleGenerativeAIEmbeddings(
+                model=self.embedding_model_name,
+                google_api_key=api_key,
+            )
+            
+            # Batch, parallelize and rate-limit requests to the embedding API
+            self.embedding_model = EmbeddingPipeline(
+                self.embedding_model,
+                batch_size=embedding_batch_size,
+                max_in_flight=max_embedding_requests,
+                requests_per_second=embedding_requests_per_second,
+            )
+        
+        # Put the chunk embedding cache in front of the model
+        if embedding_cache_path:
+            self.embedding_model = CachedEmbeddings(
+                self.embedding_model,
+                EmbeddingCache(embedding_cache_path),
+                self.embedding_model_name,
+            )
         
         # Initialize the Gemini model for chat
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-pro",
-            google_api_key=api_key,
-            temperature=0.2,
-        )
+        self.llm = llm
+        if self.llm is None and api_key:
+            self.llm = ChatGoogleGenerativeAI(
+                model="gemini-pro",
+                google_api_key=api_key,
+                temperature=0.2,
+            )
         
-        # Initialize text splitter for chunking
+        # Initialize text splitter for chunking; it sets the chunk size and splits
+        # text blocks that are too long to fit in one chunk
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
             length_function=len,
         )
         
+        # The corpus: one vector store holding the chunks of every added document,
+        # and a BM25 index over the same chunks in the same row order
         self.vector_store = None
-        self.pdf_text = ""
+        self.lexical_index = BM25Index()
+        self.documents = {}  # doc_id -> {"source", "path", "start", "num_chunks"}
+        self.pdf_text = ""  # Text of the PDF last read by load_pdf
+        self.last_sources = []  # Chunks the last answer was based on, with page and boxes
+        
+    def get_extraction_pool(self) -> ProcessPoolExecutor:
+        """The process pool used for text extraction, started on first use."""
+        if self.extraction_pool is None:
+            self.extraction_pool = ProcessPoolExecutor(max_workers=self.extraction_workers)
+        return self.extraction_pool
+    
+    def close(self) -> None:
+        """Stop the extraction worker processes."""
+        if self.extraction_pool is not None:
+            self.extraction_pool.shutdown()
+            self.extraction_pool = None
+    
+    def iter_pages(self, pdf_path: str, num_pages: int,
+                   extract: Callable = extract_page_blocks) -> Iterator[Any]:
+        """Yield each page of a PDF in order as the extraction workers finish them."""
+        yield from self.iter_document_pages([(pdf_path, num_pages)], extract)
+    
+    def iter_document_pages(self, documents: List[Tuple[str, int]],
+                            extract: Callable = extract_page_blocks) -> Iterator[Any]:
+        """Yield every page of several PDFs, given as (pdf_path, num_pages), in order.
+        
+        extract is extract_page_blocks or extract_page_texts. Pages are extracted
+        in ranges of pages_per_task, with at most two ranges per worker in
+        flight, so a long document never sits in memory whole. Ranges run on
+        ahead into the next documents, which keeps the workers busy on
+        directories of short papers.
+        """
+        ranges = (
+            (pdf_path, start, min(start + self.pages_per_task, num_pages))
+            for pdf_path, num_pages in documents
+            for start in range(0, num_pages, self.pages_per_task)
+        )
+        total_pages = sum(num_pages for _, num_pages in documents)
+        if self.extraction_workers < 2 or total_pages < 2 * self.pages_per_task:
+            for pdf_path, start, stop in ranges:
+                yield from extract(pdf_path, start, stop, self.pdf_backend)
+            return
+        
+        pool = self.get_extraction_pool()
+        in_flight = []
         
+        def submit_next(count: int) -> None:
+            for pdf_path, start, stop in itertools.islice(ranges, count):
+                in_flight.append(pool.submit(extract, pdf_path, start, stop, self.pdf_backend))
+        
+        submit_next(self.extraction_workers * 2)
+        while in_flight:
+            texts = in_flight.pop(0).result()
+            submit_next(1)
+            yield from texts
+    
     def load_pdf(self, pdf_path: str) -> str:
-        """Extract text from a PDF file."""
+        """Extract the plain text of a PDF, splitting the pages across the process pool."""
         print(f"Loading PDF from {pdf_path}...")
-        pdf_reader = PdfReader(pdf_path)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        self.pdf_text = text
-        print(f"Extracted {len(text)} characters from PDF.")
-        return text
+        num_pages = count_pages(pdf_path, self.pdf_backend)
+        self.pdf_text = "".join(self.iter_pages(pdf_path, num_pages, extract_page_texts))
+        print(f"Extracted {len(self.pdf_text)} characters from {num_pages} pages.")
+        return self.pdf_text
     
-    def process_pdf(self, pdf_path: str) -> None:
-        """Process a PDF document and create a vector store from its content."""
-        # Extract text from PDF
-        text = self.load_pdf(pdf_path)
-        
-        # Split text into chunks
-        print("Splitting text into chunks...")
-        chunks = self.text_splitter.split_text(text)
-        print(f"Created {len(chunks)} text chunks.")
-        
-        # Create vector store
-        print("Creating vector store...")
-        self.vector_store = FAISS.from_texts(chunks, self.embedding_model)
+    def index_config(self) -> Dict[str, Any]:
+        """Settings that change the contents of an index; part of its cache key."""
+        return {
+            "chunk_size": self.text_splitter._chunk_size,
+            "chunk_overlap": self.text_splitter._chunk_overlap,
+            "embedding_model": self.embedding_model_name,
+            "pdf_backend": self.pdf_backend,
+            "index_format": 4,  # Per-page chunks with document, page and box metadata
+        }
+    
+    def index_path(self, doc_id: str) -> str:
+        """Directory for the saved index of a document under the current configuration."""
+        config = json.dumps(self.index_config(), sort_keys=True)
+        key = hashlib.sha256(f"{doc_id}:{config}".encode("utf-8")).hexdigest()
+        return os.path.join(self.index_dir, key)
+    
+    def save_vector_store(self, store: FAISS, path: str, source: str, num_chunks: int) -> None:
+        """Save a vector store, its chunk texts and metadata to a directory."""
+        store.save_local(path)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"source": source, "num_chunks": num_chunks, **self.index_config()}, f, indent=2)
+    
+    def load_vector_store(self, path: str) -> FAISS:
+        """Load a saved vector store, memory-mapping the FAISS index when possible."""
+        import faiss  # Imported by langchain's FAISS wrapper on demand as well
+        
+        index_file = os.path.join(path, "index.faiss")
+        try:
+            mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(index_file, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Older FAISS builds can only mmap some index types
+            index = faiss.read_index(index_file)
+        
+        # The pickle was written by save_vector_store, so it is trusted
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(self.embedding_model, index, docstore, index_to_docstore_id)
+    
+    def iter_chunks(self, pages: Iterable[List[tuple]], metadata: Dict[str, Any]) -> Iterator[Document]:
+        """Pack each page's text blocks into chunks that record where they came from.
+        
+        Chunks never cross a page. Each one carries the 1-based page number and
+        the bounding boxes of the blocks it was built from, so a viewer can jump
+        straight to the source. Consecutive chunks on a page share trailing
+        blocks up to the splitter's overlap; blocks longer than a chunk are
+        split by the text splitter and keep the whole block's box.
+        """
+        chunk_size = self.text_splitter._chunk_size
+        chunk_overlap = self.text_splitter._chunk_overlap
+        num_chunks = 0
+        
+        def make_chunk(pieces: List[tuple], page: int) -> Document:
+            nonlocal num_chunks
+            boxes = []
+            for _, bbox in pieces:
+                if bbox is not None and list(bbox) not in boxes:
+                    boxes.append(list(bbox))
+            chunk = Document(
+                page_content="\n".join(text for text, _ in pieces),
+                metadata={**metadata, "page": page, "boxes": boxes, "chunk": num_chunks},
+            )
+            num_chunks += 1
+            return chunk
+        
+        for page, blocks in enumerate(pages, 1):
+            pieces = []
+            for text, bbox in blocks:
+                text = text.strip()
+                if len(text) > chunk_size:
+                    pieces.extend((part, bbox) for part in self.text_splitter.split_text(text))
+                elif text:
+                    pieces.append((text, bbox))
+            
+            current = []
+            length = 0
+            for piece in pieces:
+                if current and length + len(piece[0]) > chunk_size:
+                    yield make_chunk(current, page)
+                    # Carry the trailing blocks over as overlap, as long as the next one still fits
+                    while current and (length > chunk_overlap or length + len(piece[0]) > chunk_size):
+                        length -= len(current.pop(0)[0]) + 1
+                current.append(piece)
+                length += len(piece[0]) + 1
+            if current:
+                yield make_chunk(current, page)
+    
+    def build_document_store(self, pdf_path: str, doc_id: str, pages: Iterable[List[tuple]] = None,
+                             num_pages: int = None,
+                             progress: Callable[[int, int, int], None] = None) -> FAISS:
+        """Extract, split and embed one PDF into a vector store of its own.
+        
+        pages, if given, are lists of text blocks as from extract_page_blocks;
+        an iterator of them needs num_pages as well.
+        The stages overlap: pages stream from the extraction workers through the
+        splitter into batches that a separate thread embeds and appends to the
+        store. The batch queue is bounded, so extraction waits for embedding
+        rather than piling up text. progress(pages_done, num_pages, chunks_indexed)
+        is called after each batch is indexed; by default it prints a line.
+        """
+        if pages is None:
+            print(f"Loading PDF from {pdf_path}...")
+            num_pages = count_pages(pdf_path, self.pdf_backend)
+            pages = self.iter_pages(pdf_path, num_pages)
+        elif num_pages is None:
+            num_pages = len(pages)
+        progress = progress or (lambda done, total, chunks: print(
+            f"Indexed {chunks} chunks from {done}/{total} pages"
+        ))
+        
+        metadata = {"doc_id": doc_id, "source": os.path.basename(pdf_path)}
+        batches = queue.Queue(maxsize=self.ingest_queue_size)
+        store = None
+        error = None
+        
+        def index_batches() -> None:
+            nonlocal store, error
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if error is not None:
+                    continue  # Drain the queue so the producer never blocks
+                chunks, pages_done = item
+                try:
+                    if store is None:
+                        store = FAISS.from_documents(chunks, self.embedding_model)
+                    else:
+                        store.add_documents(chunks)
+                    progress(pages_done, num_pages, store.index.ntotal)
+                except Exception as e:
+                    error = e
+        
+        indexer = threading.Thread(target=index_batches, daemon=True)
+        indexer.start()
+        
+        pages_done = 0
+        
+        def count_pages_done(pages: Iterable[Any]) -> Iterator[Any]:
+            nonlocal pages_done
+            for page in pages:
+                yield page
+                pages_done += 1
+        
+        try:
+            batch = []
+            for chunk in self.iter_chunks(count_pages_done(pages), metadata):
+                batch.append(chunk)
+                if len(batch) >= self.ingest_batch_size:
+                    batches.put((batch, pages_done))
+                    batch = []
+                if error is not None:
+                    break
+            if batch and error is None:
+                batches.put((batch, pages_done))
+        finally:
+            batches.put(None)
+            indexer.join()
+        
+        if error is not None:
+            raise error
+        if store is None:
+            raise ValueError(f"No text could be extracted from {pdf_path}")
         print("Vector store created successfully.")
+        return store
     
-    def answer_question(self, question: str, k: int = 5) -> str:
-        """Answer a question based on the content of the loaded PDF."""
-        if not self.vector_store:
-            return "Please load a PDF document first."
+    def index_factory_string(self, dimension: int, num_vectors: int) -> str:
+        """FAISS factory string of the configured corpus index for a training sample size."""
+        spec = INDEX_TYPES.get(self.index_type, self.index_type)
+        # About 4 * sqrt(n) clusters, with enough training points for each one
+        nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+        # One byte per 8 dimensions, rounded down to a divisor of the dimension
+        m = max(d for d in range(1, max(dimension // 8, 1) + 1) if dimension % d == 0)
+        return spec.format(nlist=nlist, m=m)
+    
+    def new_corpus(self, dimension: int) -> FAISS:
+        """An empty, writable vector store that documents are merged into."""
+        import faiss
+        index = faiss.index_factory(dimension, self.index_factory_string(dimension, 0))
         
-        # Retrieve relevant chunks
-        print(f"Retrieving {k} most relevant chunks for question: {question}")
-        docs = self.vector_store.similarity_search(question, k=k)
-        context = "\n\n".join([doc.page_content for doc in docs])
+        # Indexes that must be trained start out exact until there is data to train on
+        self.corpus_needs_training = not index.is_trained
+        if self.corpus_needs_training:
+            index = faiss.IndexFlatL2(dimension)
+        self.lexical_index = BM25Index()
+        self.corpus_changed()
+        return FAISS(self.embedding_model, index, InMemoryDocstore(), {})
+    
+    def corpus_changed(self) -> None:
+        """Invalidate cached retrievals and answers after the corpus index changed."""
+        self.index_version += 1
+        if self.answer_cache:
+            self.answer_cache.clear()
+    
+    def train_index(self, sample_size: int = None) -> None:
+        """Replace the exact stand-in corpus index with the configured one, trained on a sample."""
+        import faiss
+        if not self.corpus_needs_training:
+            print(f"The corpus index ({self.index_type}) does not need training.")
+            return
+        
+        flat = self.vector_store.index
+        num_vectors = flat.ntotal
+        sample_size = min(sample_size or self.index_train_size, num_vectors)
+        factory = self.index_factory_string(flat.d, sample_size)
+        index = faiss.index_factory(flat.d, factory)
+        
+        # PQ needs a sample of at least 256 vectors whatever the index_train_size
+        needed = training_vectors_needed(index)
+        if num_vectors < needed:
+            raise ValueError(f"The {factory} index needs at least {needed} training vectors; "
+                             f"the corpus has {num_vectors}")
+        if sample_size < needed:
+            sample_size = needed
+            factory = self.index_factory_string(flat.d, sample_size)
+            index = faiss.index_factory(flat.d, factory)
+        rows = np.sort(np.random.default_rng(0).choice(num_vectors, sample_size, replace=False))
+        sample = flat.reconstruct_batch(rows)
+        
+        print(f"Training {factory} index on {sample_size} of {num_vectors} vectors...")
+        start_time = time.time()
+        index.train(sample)
+        
+        # Copy the vectors over in batches; rows keep their order, so document ranges stay valid
+        for start in range(0, num_vectors, 65536):
+            index.add(flat.reconstruct_n(start, min(65536, num_vectors - start)))
+        try:
+            # Lets IVF indexes return stored vectors by row, which MMR needs
+            faiss.extract_index_ivf(index).make_direct_map()
+        except RuntimeError:
+            pass  # Not an IVF index
+        self.vector_store.index = index
+        self.corpus_needs_training = False
+        self.corpus_changed()  # Approximate search can rank differently
+        print(f"Trained index in {time.time() - start_time:.1f}s.")
+    
+    def merge_into_corpus(self, store: FAISS) -> int:
+        """Append a document's vectors and chunks to the corpus; returns its first row.
+        
+        FAISS's own merge_from empties the source index, which a memory-mapped
+        saved index cannot do, so the vectors are copied instead. Appending keeps
+        each document in a contiguous range of rows.
+        """
+        corpus = self.vector_store
+        start = corpus.index.ntotal
+        count = store.index.ntotal
+        corpus.index.add(store.index.reconstruct_n(0, count))
+        docstore_ids = [store.index_to_docstore_id[i] for i in range(count)]
+        chunks = [store.docstore.search(_id) for _id in docstore_ids]
+        corpus.docstore.add(dict(zip(docstore_ids, chunks)))
+        self.lexical_index.add([chunk.page_content for chunk in chunks])
+        self.corpus_changed()
+        corpus.index_to_docstore_id.update(
+            {start + i: _id for i, _id in enumerate(docstore_ids)}
+        )
+        return start
+    
+    def has_saved_index(self, doc_id: str) -> bool:
+        """Whether a document's index was saved under the current configuration."""
+        return bool(self.index_dir) and os.path.exists(
+            os.path.join(self.index_path(doc_id), "meta.json")
+        )
+    
+    def add_pdf(self, pdf_path: str, doc_id: str = None, pages: Iterable[List[tuple]] = None,
+                num_pages: int = None) -> str:
+        """Add a PDF to the corpus, merging its chunks into the existing index.
+        
+        Documents are identified by content, so adding the same file twice (or
+        under another name) is a no-op. Returns the document's id. Callers that
+        already hashed or extracted the file can pass doc_id, and pages with
+        num_pages as for build_document_store.
+        """
+        doc_id = doc_id or hash_file(pdf_path)
+        if doc_id in self.documents:
+            print(f"{pdf_path} is already in the corpus.")
+            return doc_id
+        
+        # Reuse a saved index of the same document and configuration if there is one
+        path = self.index_path(doc_id) if self.index_dir else None
+        if self.has_saved_index(doc_id):
+            print(f"Loading saved vector store from {path}...")
+            store = self.load_vector_store(path)
+        else:
+            store = self.build_document_store(pdf_path, doc_id, pages, num_pages)
+            if path:
+                self.save_vector_store(store, path, os.path.abspath(pdf_path), store.index.ntotal)
+                print(f"Saved vector store to {path}.")
+        
+        if self.vector_store is None:
+            self.vector_store = self.new_corpus(store.index.d)
+        start = self.merge_into_corpus(store)
+        self.documents[doc_id] = {
+            "source": os.path.basename(pdf_path),
+            "path": os.path.abspath(pdf_path),
+            "start": start,
+            "num_chunks": store.index.ntotal,
+        }
+        print(f"Added {os.path.basename(pdf_path)} to the corpus "
+              f"({len(self.documents)} documents, {self.vector_store.index.ntotal} chunks).")
+        
+        # Train once the document is recorded, so a failed training leaves a consistent corpus
+        if self.corpus_needs_training and self.vector_store.index.ntotal >= self.index_train_size:
+            try:
+                self.train_index()
+            except ValueError as e:
+                print(f"Keeping the exact index for now: {e}")
+        return doc_id
+    
+    def add_directory(self, directory: str) -> List[str]:
+        """Add every PDF in a directory to the corpus."""
+        pdf_paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(".pdf")
+        )
+        print(f"Adding {len(pdf_paths)} PDFs from {directory}...")
+        doc_ids = [hash_file(pdf_path) for pdf_path in pdf_paths]
+        
+        # Papers are usually too short to keep the workers busy on their own, so
+        # the page ranges of every new document go through one stream that runs
+        # on ahead of the document being embedded
+        page_counts = {}
+        to_extract = []
+        for pdf_path, doc_id in zip(pdf_paths, doc_ids):
+            if doc_id not in self.documents and doc_id not in page_counts \
+                    and not self.has_saved_index(doc_id):
+                page_counts[doc_id] = count_pages(pdf_path, self.pdf_backend)
+                to_extract.append((pdf_path, page_counts[doc_id]))
+        stream = self.iter_document_pages(to_extract)
+        
+        for pdf_path, doc_id in zip(pdf_paths, doc_ids):
+            num_pages = page_counts.pop(doc_id, None)
+            if num_pages is None:
+                self.add_pdf(pdf_path, doc_id)
+            else:
+                self.add_pdf(pdf_path, doc_id, itertools.islice(stream, num_pages), num_pages)
+        return doc_ids
+    
+    def process_pdf(self, pdf_path: str) -> None:
+        """Process a PDF document and make it the only document in the corpus."""
+        self.vector_store = None
+        self.documents = {}
+        self.add_pdf(pdf_path)
+    
+    def resolve_documents(self, sources: List[str]) -> List[str]:
+        """Map file names, paths or ids to the ids of documents in the corpus."""
+        doc_ids = []
+        for source in sources:
+            matches = [
+                doc_id for doc_id, doc in self.documents.items()
+                if source in (doc_id, doc["source"], doc["path"])
+                or doc["source"].startswith(source)
+            ]
+            if not matches:
+                raise KeyError(f"No document in the corpus matches {source!r}")
+            doc_ids.extend(matches)
+        return doc_ids
+    
+    def document_rows(self, sources: List[str]) -> np.ndarray:
+        """Corpus rows of the documents matching sources."""
+        return np.concatenate([
+            np.arange(doc["start"], doc["start"] + doc["num_chunks"], dtype=np.int64)
+            for doc in (self.documents[doc_id] for doc_id in self.resolve_documents(sources))
+        ])
+    
+    def embed_question(self, question: str) -> np.ndarray:
+        """The question's query embedding as a (1, d) array, cached by normalized question."""
+        key = (self.embedding_model_name, normalize_question(question))
+        query = self.query_embedding_cache.get(key)
+        if query is None:
+            query = np.array([self.embedding_model.embed_query(question)], dtype=np.float32)
+            self.query_embedding_cache.put(key, query)
+        return query
+    
+    def vector_search(self, question: str, k: int, rows: np.ndarray = None) -> List[int]:
+        """Rows of the k chunks whose embeddings are nearest to the question's."""
+        import faiss
+        
+        query = self.embed_question(question)
+        index = self.vector_store.index
+        
+        # Restrict the search to the given rows, so filtering does not need to
+        # over-fetch and discard results from other papers
+        selector = {"sel": faiss.IDSelectorBatch(rows)} if rows is not None else {}
+        
+        # Approximate indexes take their recall/latency knobs per search
+        if isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(nprobe=self.nprobe, **selector)
+        elif isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(efSearch=self.ef_search, **selector)
+        else:
+            params = faiss.SearchParameters(**selector) if selector else None
+        
+        _, ids = index.search(query, k, params=params)
+        return [int(i) for i in ids[0] if i != -1]
+    
+    def search_rows(self, question: str, k: int, sources: List[str], retrieval: str) -> List[int]:
+        """Corpus rows of the k chunks most relevant to the question; see search."""
+        rows = self.document_rows(sources) if sources else None
+        if retrieval == "lexical":
+            return self.lexical_index.search(question, k, rows)
+        if retrieval == "vector":
+            return self.vector_search(question, k, rows)
+        depth = max(k, self.fusion_depth)
+        return reciprocal_rank_fusion([
+            self.vector_search(question, depth, rows),
+            self.lexical_index.search(question, depth, rows),
+        ])[:k]
+    
+    def answer_cache_key(self, question: str, k: int, sources: List[str], retrieval: str) -> tuple:
+        """Key of a retrieval (and its answer) in the answer cache."""
+        return (self.index_version, normalize_question(question), k,
+                tuple(sources or ()), retrieval or self.retrieval)
+    
+    def search(self, question: str, k: int = 5, sources: List[str] = None,
+               retrieval: str = None) -> List[Document]:
+        """Find the k chunks most relevant to the question, optionally within some documents.
+        
+        retrieval overrides the system default. "lexical" runs entirely locally;
+        "hybrid" fuses the top fusion_depth results of both retrievers with
+        reciprocal rank fusion, so exact terms such as acronyms and equation
+        names are found even when the embedding misses them.
+        """
+        return self.chunks_at(self.ranked_rows(question, k, sources, retrieval))
+    
+    def ranked_rows(self, question: str, k: int, sources: List[str], retrieval: str = None) -> List[int]:
+        """search_rows through the answer cache."""
+        retrieval = retrieval or self.retrieval
+        key = self.answer_cache_key(question, k, sources, retrieval)
+        cached = self.answer_cache.get(key) if self.answer_cache else None
+        if cached is not None and "rows" in cached:
+            return cached["rows"]
+        ranked = self.search_rows(question, k, sources, retrieval)
+        if self.answer_cache:
+            self.answer_cache.put(key, {**(cached or {}), "rows": ranked})
+        return ranked
+    
+    def chunks_at(self, rows: List[int]) -> List[Document]:
+        """The chunks stored at the given corpus rows."""
+        store = self.vector_store
+        return [store.docstore.search(store.index_to_docstore_id[row]) for row in rows]
+    
+    def cached_answer(self, key: tuple) -> Tuple[List[Document], str]:
+        """The context passages and answer cached under key, or None."""
+        cached = self.answer_cache.get(key) if self.answer_cache else None
+        if cached is None or "answer" not in cached:
+            return None
+        return cached["context"], cached["answer"]
+    
+    def store_answer(self, key: tuple, answer: str, context: List[Document]) -> None:
+        """Cache an answer and the context passages it was generated from."""
+        if self.answer_cache:
+            cached = self.answer_cache.get(key) or {}
+            self.answer_cache.put(key, {**cached, "answer": answer, "context": context})
+    
+    def row_vectors(self, rows: List[int]) -> np.ndarray:
+        """Vectors of corpus rows as stored in the index, or None if it cannot return them."""
+        try:
+            return self.vector_store.index.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+        except RuntimeError:
+            return None
+    
+    def select_mmr(self, rows: List[int], k: int, scores: np.ndarray = None) -> List[int]:
+        """Pick k of the ranked rows by maximal marginal relevance.
+        
+        Each pick maximizes mmr_lambda * relevance minus (1 - mmr_lambda) *
+        similarity to the rows already picked, so chunks that repeat each other
+        give way to ones that add something. Relevance is the rows' scores
+        (e.g. from the reranker) scaled to [0, 1], or without scores falls
+        linearly from 1 to 0 down the incoming ranking, rather than being
+        recomputed from the embeddings; whatever ranked the rows (hybrid
+        fusion, BM25, a reranker) still decides what matters, and the index
+        vectors only measure redundancy.
+        """
+        vectors = self.row_vectors(rows)
+        if vectors is None or len(rows) <= k:
+            return rows[:k]
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if scores is None:
+            relevance = 1.0 - np.arange(len(rows)) / len(rows)
+        else:
+            scores = np.asarray(scores, dtype=np.float64)
+            relevance = (scores - scores.min()) / max(float(scores.max() - scores.min()), 1e-12)
+        
+        picked = [int(np.argmax(relevance))]
+        redundancy = vectors @ vectors[picked[0]]
+        while len(picked) < k:
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            scores[picked] = -np.inf
+            best = int(np.argmax(scores))
+            picked.append(best)
+            redundancy = np.maximum(redundancy, vectors @ vectors[best])
+        return [rows[i] for i in picked]
+    
+    @staticmethod
+    def merge_chunks(first: Document, second: Document) -> Document:
+        """One passage from two neighbouring chunks of a page, without their shared overlap."""
+        a = first.page_content.split("\n")
+        b = second.page_content.split("\n")
+        # Chunks overlap by whole lines, so find the longest suffix of a that starts b
+        shared = next((n for n in range(min(len(a), len(b)), 0, -1) if a[-n:] == b[:n]), 0)
+        boxes = first.metadata.get("boxes", []) + [
+            box for box in second.metadata.get("boxes", []) if box not in first.metadata.get("boxes", [])
+        ]
+        return Document(
+            page_content="\n".join(a + b[shared:]),
+            metadata={**first.metadata, "boxes": boxes, "last_chunk": second.metadata["chunk"]},
+        )
+    
+    def assemble_context(self, question: str, rows: List[int]) -> List[Document]:
+        """Turn ranked rows into the passages that go into the prompt.
+        
+        Neighbouring chunks of a page are merged into one passage, so their
+        overlap is sent once; passages whose words mostly repeat a better-ranked
+        one are dropped; the rest are packed in rank order into
+        context_token_budget tokens (estimated at four characters per token).
+        """
+        chunks = self.chunks_at(rows)
+        
+        # Merge runs of consecutive chunks on the same page, keeping the best rank of each run
+        order = sorted(range(len(chunks)), key=lambda i: (
+            chunks[i].metadata["doc_id"], chunks[i].metadata["chunk"]
+        ))
+        passages = []  # (rank, passage)
+        for i in order:
+            chunk = chunks[i]
+            if passages:
+                rank, last = passages[-1]
+                if (last.metadata["doc_id"] == chunk.metadata["doc_id"]
+                        and last.metadata["page"] == chunk.metadata["page"]
+                        and last.metadata.get("last_chunk", last.metadata["chunk"]) + 1 == chunk.metadata["chunk"]):
+                    passages[-1] = (min(rank, i), self.merge_chunks(last, chunk))
+                    continue
+            passages.append((i, chunk))
+        passages = [passage for _, passage in sorted(passages, key=lambda item: item[0])]
+        
+        # Drop near-duplicates, e.g. the same paragraph in two versions of a paper
+        kept = []
+        kept_words = []
+        for passage in passages:
+            words = set(tokenize(passage.page_content))
+            if any(len(words & other) > 0.8 * min(len(words), len(other)) for other in kept_words):
+                continue
+            kept.append(passage)
+            kept_words.append(words)
         
-        # Generate prompt
-        prompt = f"""
+        # Pack into the token budget; the best passage is truncated rather than dropped
+        budget = self.context_token_budget * 4
+        context = []
+        for passage in kept:
+            size = len(passage.page_content)
+            if size <= budget:
+                context.append(passage)
+                budget -= size
+            elif not context:
+                context.append(Document(page_content=passage.page_content[:budget], metadata=passage.metadata))
+                break
+        return context
+    
+    def record_timing(self, timings: Dict[str, float], stage: str, start: float) -> float:
+        """Record the milliseconds since start for a stage; returns the current time."""
+        now = time.perf_counter()
+        elapsed = (now - start) * 1000
+        timings[stage] = elapsed
+        with self.timing_lock:
+            totals = self.timing_totals.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+        return now
+    
+    def timing_summary(self) -> Dict[str, float]:
+        """Mean milliseconds per stage over every question so far."""
+        with self.timing_lock:
+            return {stage: total / count for stage, (count, total) in self.timing_totals.items()}
+    
+    def rerank(self, question: str, rows: List[int]) -> List[int]:
+        """Reorder candidate rows by the configured reranker, best first."""
+        scores = self.rerank_scores(question, rows)
+        # Stable, so ties keep the retrieval order
+        return [rows[i] for i in np.argsort(-scores, kind="stable")]
+    
+    def rerank_scores(self, question: str, rows: List[int]) -> np.ndarray:
+        """Scores of candidate rows under the configured reranker, higher is better.
+        
+        The lexical reranker scores each chunk by the share of the question's
+        terms it contains plus its BM25 score relative to the best candidate.
+        The cross-encoder reads question and chunk together, which is slower
+        but much more precise than comparing embeddings.
+        """
+        if not rows:
+            return np.zeros(0)
+        if self.reranker == "cross-encoder":
+            if self.cross_encoder is None:
+                from sentence_transformers import CrossEncoder
+                self.cross_encoder = CrossEncoder(self.reranker_model, device="cpu")
+            texts = [chunk.page_content for chunk in self.chunks_at(rows)]
+            scores = np.asarray(self.cross_encoder.predict([(question, text) for text in texts], batch_size=32))
+        else:
+            terms = set(tokenize(question))
+            bm25 = self.lexical_index.scores(question)[rows]
+            coverage = np.array([
+                len(terms & set(tokenize(chunk.page_content))) / max(len(terms), 1)
+                for chunk in self.chunks_at(rows)
+            ])
+            scores = coverage + bm25 / max(float(bm25.max()), 1e-12)
+        return scores
+    
+    def retrieve_context(self, question: str, k: int = 5, sources: List[str] = None,
+                         retrieval: str = None, timings: Dict[str, float] = None) -> List[Document]:
+        """Retrieve passages for a prompt: search, rerank, MMR, then assemble_context.
+        
+        With a reranker, rerank_candidates chunks are fetched and reranked. With
+        mmr_lambda set, k of the best mmr_candidates are then picked by MMR (not
+        for lexical retrieval, which needs no embeddings), using the reranker's
+        scores as relevance. Stage timings are written to timings.
+        """
+        timings = {} if timings is None else timings
+        retrieval = retrieval or self.retrieval
+        use_mmr = self.mmr_lambda is not None and retrieval != "lexical"
+        keep = max(k, self.mmr_candidates) if use_mmr else k
+        
+        start = time.perf_counter()
+        fetch = max(keep, self.rerank_candidates) if self.reranker else keep
+        rows = self.ranked_rows(question, fetch, sources, retrieval)
+        start = self.record_timing(timings, "retrieve", start)
+        scores = None
+        if self.reranker:
+            scores = self.rerank_scores(question, rows)
+            order = np.argsort(-scores, kind="stable")[:keep]
+            rows, scores = [rows[i] for i in order], scores[order]
+            start = self.record_timing(timings, "rerank", start)
+        if use_mmr:
+            rows = self.select_mmr(rows, k, scores)
+            start = self.record_timing(timings, "mmr", start)
+        context = self.assemble_context(question, rows)
+        self.record_timing(timings, "assemble", start)
+        return context
+    
+    def build_prompt(self, question: str, docs: List[Document]) -> str:
+        """The prompt asking the LLM to answer a question from retrieved chunks."""
+        context = "\n\n".join(
+            f"[{doc.metadata['source']}, page {doc.metadata['page']}]\n{doc.page_content}"
+            for doc in docs
+        )
+        
+        return f"""
         You are a helpful assistant that accurately answers questions based on the provided context.
         If the answer cannot be found in the context, say "I don't have enough information to answer this question."
         Do not make up or infer information that is not explicitly stated in the context.
@@ -95,11 +1385,186 @@ class RAGSystem:
         
         Answer:
         """
+    
+    def stream_answer(self, question: str, k: int = 5, sources: List[str] = None,
+                      retrieval: str = None) -> Iterator[str]:
+        """Answer a question like answer_question, yielding the text as the LLM produces it.
+        
+        A cached answer is yielded in one piece. The answer is only cached once
+        the stream has been read to the end.
+        """
+        if not self.vector_store:
+            yield "Please load a PDF document first."
+            return
+        
+        # A repeat of a recent question against the same index is answered from the cache
+        self.last_timings = {}
+        key = self.answer_cache_key(question, k, sources, retrieval)
+        cached = self.cached_answer(key)
+        if cached is not None:
+            self.last_sources, answer = cached
+            yield answer
+            return
+        
+        # Retrieve relevant chunks
+        print(f"Retrieving {k} most relevant chunks for question: {question}")
+        docs = self.retrieve_context(question, k=k, sources=sources, retrieval=retrieval,
+                                     timings=self.last_timings)
+        self.last_sources = docs
+        prompt = self.build_prompt(question, docs)
+        if self.llm is None:
+            raise RuntimeError("No chat model: pass an api_key or llm to generate answers")
         
         # Generate answer
         print("Generating answer...")
-        response = self.llm.invoke(prompt)
-        return response.content
+        parts = []
+        start = time.perf_counter()
+        for chunk in self.llm.stream(prompt):
+            if chunk.content:
+                if not parts:
+                    self.record_timing(self.last_timings, "first_token", start)
+                parts.append(chunk.content)
+                yield chunk.content
+        self.record_timing(self.last_timings, "generate", start)
+        
+        self.store_answer(key, "".join(parts), docs)
+    
+    def answer_question(self, question: str, k: int = 5, sources: List[str] = None,
+                        retrieval: str = None) -> str:
+        """Answer a question based on the content of the loaded PDFs.
+        
+        Pass sources (file names, paths or document ids) to only use those documents.
+        The retrieved chunks are kept in last_sources.
+        """
+        return "".join(self.stream_answer(question, k=k, sources=sources, retrieval=retrieval))
+
+class RAGService:
+    """Answers questions from many concurrent users with one shared RAGSystem.
+    
+    The RAGSystem's corpus is only read. Retrieval runs on a small thread pool
+    (FAISS and the embedding client release the GIL) and generation uses the
+    LLM's async API, with at most max_concurrent_llm calls in flight. A question
+    that is already being answered is not asked again: later callers wait for
+    the same answer. Async callers await ask/stream on their own loop; sync
+    callers such as Flask call start() once, then ask_sync/stream_sync.
+    """
+    
+    def __init__(self, rag: RAGSystem, max_concurrent_llm: int = 8, retrieval_workers: int = 4):
+        if rag.llm is None:
+            raise RuntimeError("No chat model: pass an api_key or llm to generate answers")
+        self.rag = rag
+        self.llm_slots = asyncio.Semaphore(max_concurrent_llm)
+        self.retrieval_pool = ThreadPoolExecutor(max_workers=retrieval_workers)
+        self.in_flight = {}  # answer cache key -> Future of (chunks, answer)
+        self.loop = None  # Event loop of start()
+        self.thread = None
+    
+    @staticmethod
+    def result(docs: List[Document], answer: str) -> Dict[str, Any]:
+        """The JSON-friendly form of an answer and its sources."""
+        return {
+            "answer": answer,
+            "sources": [
+                {key: doc.metadata.get(key) for key in ("source", "page", "boxes")}
+                for doc in docs
+            ],
+        }
+    
+    async def retrieve(self, question: str, k: int, sources: List[str], retrieval: str) -> List[Document]:
+        """Run the system's (blocking) search on the retrieval pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.retrieval_pool,
+            lambda: self.rag.retrieve_context(question, k=k, sources=sources, retrieval=retrieval),
+        )
+    
+    async def generate(self, key: tuple, question: str, k: int, sources: List[str],
+                       retrieval: str) -> Tuple[List[Document], str]:
+        """Retrieve, then ask the LLM for an answer within the concurrency limit."""
+        docs = await self.retrieve(question, k, sources, retrieval)
+        prompt = self.rag.build_prompt(question, docs)
+        async with self.llm_slots:
+            start = time.perf_counter()
+            response = await self.rag.llm.ainvoke(prompt)
+            self.rag.record_timing({}, "generate", start)
+        self.rag.store_answer(key, response.content, docs)
+        return docs, response.content
+    
+    async def ask(self, question: str, k: int = 5, sources: List[str] = None,
+                  retrieval: str = None) -> Dict[str, Any]:
+        """Answer a question; see RAGSystem.answer_question and result."""
+        if not self.rag.vector_store:
+            return self.result([], "Please load a PDF document first.")
+        
+        key = self.rag.answer_cache_key(question, k, sources, retrieval)
+        cached = self.rag.cached_answer(key)
+        if cached is not None:
+            return self.result(*cached)
+        
+        # Coalesce identical questions that arrive while one is being answered
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.generate(key, question, k, sources, retrieval))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded so one caller going away does not cancel the others' answer
+        return self.result(*await asyncio.shield(future))
+    
+    async def stream(self, question: str, k: int = 5, sources: List[str] = None,
+                     retrieval: str = None) -> AsyncIterator[str]:
+        """Yield an answer's text as it is generated; see RAGSystem.stream_answer."""
+        if not self.rag.vector_store:
+            yield "Please load a PDF document first."
+            return
+        
+        key = self.rag.answer_cache_key(question, k, sources, retrieval)
+        cached = self.rag.cached_answer(key)
+        if cached is not None:
+            yield cached[1]
+            return
+        
+        docs = await self.retrieve(question, k, sources, retrieval)
+        prompt = self.rag.build_prompt(question, docs)
+        parts = []
+        async with self.llm_slots:
+            async for chunk in self.rag.llm.astream(prompt):
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield chunk.content
+        self.rag.store_answer(key, "".join(parts), docs)
+    
+    def start(self) -> None:
+        """Run the service's event loop on a background thread, for sync callers."""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+    
+    def ask_sync(self, *args, **kwargs) -> Dict[str, Any]:
+        """ask, from a thread outside the service loop."""
+        return asyncio.run_coroutine_threadsafe(self.ask(*args, **kwargs), self.loop).result()
+    
+    def stream_sync(self, *args, **kwargs) -> Iterator[str]:
+        """stream, from a thread outside the service loop."""
+        stream = self.stream(*args, **kwargs)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            # Release the LLM slot if the reader stopped early, e.g. a client disconnected
+            asyncio.run_coroutine_threadsafe(stream.aclose(), self.loop).result()
+    
+    def close(self) -> None:
+        """Stop the background loop and the retrieval pool."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+        self.retrieval_pool.shutdown()
 
 if __name__ == "__main__":
     import argparse
@@ -107,37 +1572,151 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="RAG system using Google Gemini")
     parser.add_argument("--api_key", type=str, help="Google Gemini API key")
     parser.add_argument("--pdf", type=str, help="Path to PDF file")
+    parser.add_argument("--corpus", type=str, help="Directory of PDFs to add to the corpus")
+    parser.add_argument("--index_dir", type=str, default=DEFAULT_INDEX_DIR,
+                        help="Directory for saved vector stores (empty string to disable)")
+    parser.add_argument("--embedding_cache", type=str, default=DEFAULT_EMBEDDING_CACHE,
+                        help="SQLite file caching chunk embeddings (empty string to disable)")
+    parser.add_argument("--pdf_backend", type=str, default=DEFAULT_PDF_BACKEND, choices=PDF_BACKENDS,
+                        help="Library used to extract text from PDFs")
+    parser.add_argument("--extraction_workers", type=int, default=None,
+                        help="Processes used for text extraction (default: one per core)")
+    parser.add_argument("--index_type", type=str, default="flat",
+                        help=f"Corpus index: one of {', '.join(INDEX_TYPES)} or a FAISS factory string")
+    parser.add_argument("--index_train_size", type=int, default=20000,
+                        help="Chunks to collect before training an IVF/PQ/SQ8 corpus index")
+    parser.add_argument("--nprobe", type=int, default=16,
+                        help="IVF clusters searched per query (higher: better recall, slower)")
+    parser.add_argument("--ef_search", type=int, default=64,
+                        help="HNSW search breadth (higher: better recall, slower)")
+    parser.add_argument("--retrieval", type=str, default="hybrid", choices=RETRIEVAL_MODES,
+                        help="How chunks are retrieved for answers")
+    parser.add_argument("--answer_cache_ttl", type=float, default=3600.0,
+                        help="Seconds to reuse answers to repeated questions (0 to disable)")
+    parser.add_argument("--embedding_backend", type=str, default="gemini", choices=EMBEDDING_BACKENDS,
+                        help="Embedding provider; hashing and sentence-transformers run locally")
+    parser.add_argument("--embedding_model", type=str, default=None,
+                        help="Model name for the embedding backend")
+    parser.add_argument("--context_tokens", type=int, default=1500,
+                        help="Token budget for retrieved passages in the prompt")
+    parser.add_argument("--mmr_lambda", type=float, default=0.7,
+                        help="MMR relevance/diversity balance (1 = relevance only)")
+    parser.add_argument("--reranker", type=str, default=None, choices=RERANKERS,
+                        help="Rerank retrieved candidates on the CPU before answering")
+    parser.add_argument("--rerank_candidates", type=int, default=50,
+                        help="Candidates fetched for the reranker")
     
     args = parser.parse_args()
     
-    if not args.api_key:
-        api_key = input("Enter your Google Gemini API key: ")
-    else:
+    if args.api_key:
         api_key = args.api_key
+    elif args.embedding_backend != "gemini":
+        # Local embeddings work offline; without a key questions show passages only
+        api_key = input("Enter your Google Gemini API key (empty to work offline): ") or None
+    else:
+        api_key = input("Enter your Google Gemini API key: ")
     
-    rag = RAGSystem(api_key)
+    rag = RAGSystem(api_key, index_dir=args.index_dir or None,
+                    embedding_cache_path=args.embedding_cache or None,
+                    pdf_backend=args.pdf_backend,
+                    extraction_workers=args.extraction_workers,
+                    index_type=args.index_type,
+                    index_train_size=args.index_train_size,
+                    nprobe=args.nprobe, ef_search=args.ef_search,
+                    retrieval=args.retrieval,
+                    answer_cache_ttl=args.answer_cache_ttl,
+                    embedding_backend=args.embedding_backend,
+                    embedding_model_name=args.embedding_model,
+                    context_token_budget=args.context_tokens,
+                    mmr_lambda=args.mmr_lambda,
+                    reranker=args.reranker,
+                    rerank_candidates=args.rerank_candidates)
     
+    def ingest(command: Callable[[str], Any], path: str) -> None:
+        """Run an ingestion command, reporting embedding failures instead of exiting.
+        
+        The embedding pipeline remembers the batches that finished, so running
+        the same command again in this session resumes from them.
+        """
+        try:
+            command(path)
+        except EmbeddingPipelineError as e:
+            print(f"Error: {e}")
+            print("Run the same command again to resume from the completed batches.")
+    
+    if args.corpus:
+        ingest(rag.add_directory, args.corpus)
     if args.pdf:
-        rag.process_pdf(args.pdf)
+        ingest(rag.add_pdf, args.pdf)
     
     # Interactive Q&A loop
     print("\nRAG System Ready! Enter 'quit' or 'exit' to end the session.")
     print("Enter 'load' followed by a PDF path to load a new document.")
+    print("Enter 'add' followed by a PDF or directory to add it to the corpus, 'docs' to list it.")
+    print("Start a question with '@<file name>' to only search that document.")
+    print("Enter 'train' to train a compressed corpus index now instead of at --index_train_size.")
+    print("Start with '?' to look up keywords locally, showing matching passages without asking Gemini.")
     
     while True:
         user_input = input("\nQuestion: ")
         
         if user_input.lower() in ["quit", "exit"]:
+            rag.close()
             break
         
         if user_input.lower().startswith("load "):
             pdf_path = user_input[5:].strip()
-            rag.process_pdf(pdf_path)
+            ingest(rag.process_pdf, pdf_path)
+            continue
+        
+        if user_input.lower().startswith("add "):
+            path = user_input[4:].strip()
+            ingest(rag.add_directory if os.path.isdir(path) else rag.add_pdf, path)
+            continue
+        
+        if user_input.lower() == "train":
+            if rag.vector_store:
+                try:
+                    rag.train_index()
+                except ValueError as e:
+                    print(f"Error: {e}")
+            continue
+        
+        if user_input.lower() == "docs":
+            for doc_id, doc in rag.documents.items():
+                print(f"{doc['source']}  ({doc['num_chunks']} chunks, id {doc_id[:12]})")
             continue
         
         if not rag.vector_store:
             print("Please load a PDF document first using 'load <pdf_path>'")
             continue
         
-        answer = rag.answer_question(user_input)
-        print(f"\nAnswer: {answer}")
+        sources = None
+        if user_input.startswith("@"):
+            source, _, user_input = user_input[1:].partition(" ")
+            sources = [source]
+        
+        try:
+            if user_input.startswith("?") or rag.llm is None:
+                # Keyword lookup: BM25 only, so no embedding or LLM call is made.
+                # Offline, questions show the retrieved passages instead of an answer.
+                query = user_input[1:].strip() if user_input.startswith("?") else user_input
+                retrieval = "lexical" if user_input.startswith("?") else None
+                for doc in rag.search(query, k=5, sources=sources, retrieval=retrieval):
+                    print(f"\n[{doc.metadata['source']}, page {doc.metadata['page']}]\n{doc.page_content}")
+                continue
+            
+            # Print the answer as it is generated
+            answer = rag.stream_answer(user_input, sources=sources)
+            first = next(answer, "")
+            print(f"\nAnswer: {first}", end="", flush=True)
+            for text in answer:
+                print(text, end="", flush=True)
+            print()
+            if rag.last_timings:
+                print("Timings: " + ", ".join(f"{stage} {ms:.0f} ms" for stage, ms in rag.last_timings.items()))
+        except KeyError as e:
+            print(e.args[0])
+            continue
+        cited = dict.fromkeys(f"{doc.metadata['source']} p.{doc.metadata['page']}" for doc in rag.last_sources)
+        print(f"Sources: {', '.join(cited)}")
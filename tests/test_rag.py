@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from rag import (EmbeddingPipeline, EmbeddingPipelineError, HashingEmbeddings, QueryCache, RAGService,
+                 RAGSystem, reciprocal_rank_fusion)
+
+PAGES = [
+    [("Generative adversarial networks train a generator against a discriminator.", (0, 0, 100, 20))],
+    [("The discriminator estimates the probability that a sample came from the data.", (0, 0, 100, 20))],
+    [("Markov chains are not needed during training or generation.", (0, 0, 100, 20))],
+]
+
+class FlakyEmbeddings(Embeddings):
+    """Local embeddings that fail on chosen calls, counting every call."""
+
+    def __init__(self, fail_calls=(), fail_text=None):
+        self.inner = HashingEmbeddings(dimension=64)
+        self.fail_calls = set(fail_calls)
+        self.fail_text = fail_text  # Fail every batch containing this text
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        if len(self.calls) in self.fail_calls or self.fail_text in texts:
+            raise ConnectionError("embedding service unavailable")
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.inner.embed_query(text)
+
+def make_pipeline(embeddings, max_retries):
+    return EmbeddingPipeline(embeddings, batch_size=2, max_in_flight=1, requests_per_second=1000.0,
+                             max_retries=max_retries, backoff=0.0)
+
+def make_rag(answers, **kwargs):
+    llm = GenericFakeChatModel(messages=iter(AIMessage(content=answer) for answer in answers))
+    rag = RAGSystem(index_dir=None, embedding_cache_path=None, embedding_backend="hashing",
+                    extraction_workers=1, llm=llm, **kwargs)
+    rag.add_pdf("paper.pdf", doc_id="paper", pages=PAGES)
+    return rag
+
+def test_pipeline_retries_failed_batches():
+    embeddings = FlakyEmbeddings(fail_calls={1, 2})
+    texts = ["a b", "c d", "e f"]
+    vectors = make_pipeline(embeddings, max_retries=2).embed_documents(texts)
+
+    assert vectors == HashingEmbeddings(dimension=64).embed_documents(texts)
+    assert len(embeddings.calls) == 4  # Two failures, then both batches
+
+def test_pipeline_resumes_from_completed_batches():
+    embeddings = FlakyEmbeddings(fail_text="e f")
+    pipeline = make_pipeline(embeddings, max_retries=0)
+    texts = ["a b", "c d", "e f", "g h"]
+    with pytest.raises(EmbeddingPipelineError) as error:
+        pipeline.embed_documents(texts)
+    assert (error.value.completed, error.value.total) == (1, 2)
+
+    embeddings.fail_text = None
+    embeddings.calls = []
+    vectors = pipeline.embed_documents(texts)
+    assert embeddings.calls == [["e f", "g h"]]  # The first batch was not embedded again
+    assert vectors == HashingEmbeddings(dimension=64).embed_documents(texts)
+    assert pipeline.completed_batches == {}
+
+def test_stream_answer_yields_tokens_and_caches_answer():
+    rag = make_rag(["Adversarial nets need no Markov chains."])
+    parts = list(rag.stream_answer("What do adversarial nets avoid?", k=2))
+
+    assert len(parts) > 1
+    assert "".join(parts) == "Adversarial nets need no Markov chains."
+    assert rag.last_sources
+    # The fake model has no second answer, so this must come from the cache
+    assert list(rag.stream_answer("What do adversarial nets avoid?", k=2)) == [
+        "Adversarial nets need no Markov chains."
+    ]
+
+def test_service_coalesces_identical_questions():
+    rag = make_rag(["Only one answer."], answer_cache_ttl=0)
+    service = RAGService(rag)
+
+    async def ask_twice():
+        return await asyncio.gather(
+            service.ask("What is the discriminator?"),
+            service.ask("What is the discriminator?"),
+        )
+
+    first, second = asyncio.run(ask_twice())
+    assert first == second
+    assert first["answer"] == "Only one answer."
+    assert first["sources"][0]["source"] == "paper.pdf"
+    assert service.in_flight == {}
+    service.close()
+
+def test_service_stream_sync():
+    rag = make_rag(["Streamed from the service loop."])
+    service = RAGService(rag)
+    service.start()
+    try:
+        parts = list(service.stream_sync("What is the generator trained against?"))
+        assert "".join(parts) == "Streamed from the service loop."
+        assert service.ask_sync("What is the generator trained against?")["answer"] == (
+            "Streamed from the service loop."
+        )
+    finally:
+        service.close()
+
+def test_service_requires_a_chat_model():
+    rag = make_rag([])
+    rag.llm = None
+    with pytest.raises(RuntimeError):
+        RAGService(rag)
+
+def test_hybrid_search_stays_within_sources():
+    rag = make_rag([])
+    rag.add_pdf("other.pdf", doc_id="other", pages=[[("Another discriminator, in another paper.", None)]])
+
+    assert sorted(rag.lexical_index.search("discriminator", 10)) == [0, 1, 3]
+    assert rag.lexical_index.search("discriminator", 10, rows=np.array([2, 3])) == [3]
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 1]]) == [1, 3, 2]
+    docs = rag.search("discriminator", k=5, sources=["other"])
+    assert [doc.metadata["doc_id"] for doc in docs] == ["other"]
+
+def test_answer_cache_expires_and_follows_the_corpus():
+    cache = QueryCache(ttl=0.05)
+    cache.put("key", "value")
+    assert cache.get("key") == "value"
+    time.sleep(0.1)
+    assert cache.get("key") is None
+
+    rag = make_rag(["Before.", "After."])
+    assert "".join(rag.stream_answer("What is new?")) == "Before."
+    assert "".join(rag.stream_answer("what is NEW")) == "Before."  # Normalized repeat
+    rag.add_pdf("other.pdf", doc_id="other", pages=[[("Something new.", None)]])
+    assert "".join(rag.stream_answer("What is new?")) == "After."
+
+def test_assemble_context_merges_drops_duplicates_and_fits_budget():
+    rag = make_rag([])
+    alpha, beta, gamma = ("alpha " * 100).strip(), ("beta " * 100).strip(), ("gamma " * 100).strip()
+    rag.add_pdf("long.pdf", doc_id="long", pages=[[(alpha, (0, 0, 1, 1)), (beta, (0, 2, 1, 3)), (gamma, (0, 4, 1, 5))]])
+    rag.add_pdf("copy.pdf", doc_id="copy", pages=[[(beta, (0, 0, 1, 1))]])
+    alpha_row, beta_row = rag.documents["long"]["start"], rag.documents["long"]["start"] + 1
+    copy_row = rag.documents["copy"]["start"]
+
+    # Neighbouring chunks merge into one passage and the copy of beta is dropped
+    context = rag.assemble_context("alpha", [alpha_row, copy_row, beta_row, 0])
+    assert [doc.metadata["doc_id"] for doc in context] == ["long", "paper"]
+    assert context[0].page_content == f"{alpha}\n{beta}"
+    assert context[0].metadata["boxes"] == [[0, 0, 1, 1], [0, 2, 1, 3]]
+
+    # Passages that no longer fit the budget are left out; the first one is truncated
+    rag.context_token_budget = 260
+    assert [doc.metadata["doc_id"] for doc in rag.assemble_context("alpha", [alpha_row, beta_row, 0])] == ["long"]
+    rag.context_token_budget = 100
+    assert len(rag.assemble_context("alpha", [alpha_row, beta_row, 0])[0].page_content) == 400
@@ -1,8 +1,19 @@
+import os
 import sys
+import json
+import time
+import zlib
+import struct
+import sqlite3
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext, ttk
 from PIL import Image, ImageTk, ImageDraw, ImageDraw
 import threading
+import heapq
+import numpy as np
+import math
+from collections import OrderedDict, namedtuple
+from cache_utils import DEFAULT_CACHE_DIR, hash_file, evict_lru
 
 # Fix for PyMuPDF import - use explicit import to avoid module conflict
 # try:
@@ -16,8 +27,281 @@ except ImportError:
     print("Please install it using: pip install PyMuPDF")
     sys.exit(1)
 
+# Priority bands for render jobs, lowest runs first; within a band, pages
+# nearer the current page go first
+PRIORITY_SELECTION_TEXT = 0  # Text layer needed by a selection that just started
+PRIORITY_PREVIEW = 1         # Low-resolution first paint of a page with nothing to show
+PRIORITY_RENDER = 2          # Full-quality pages and tiles in view
+PRIORITY_PREFETCH = 3        # Pages ahead of the view in the direction of travel
+PRIORITY_IDLE_TEXT = 4       # Text layers prefetched while the workers are idle
+
+# The document a render job was queued for. Jobs carry it with them so a job
+# still running when another PDF is opened keeps reading (and caching) the old
+# document, and its result can be recognised as stale and dropped.
+DocumentState = namedtuple("DocumentState", ["doc", "doc_hash", "generation"])
+
+class RenderScheduler:
+    """Fixed-size pool of render workers fed by a priority queue"""
+    def __init__(self, num_workers=2, is_wanted=None):
+        self.condition = threading.Condition()
+        self.queue = []          # Heap of (priority, seq, key, func)
+        self.pending = {}        # key -> seq of the live queue entry for that key
+        self.running = set()     # Keys currently being rendered by a worker
+        self.seq = 0             # Tie-breaker so equal priorities stay FIFO
+        self.is_wanted = is_wanted or (lambda key: True)
+
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self.worker_loop, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, priority, func):
+        """Queue a render job, replacing any queued job with the same key"""
+        with self.condition:
+            # Don't queue a second copy of a page that is already being rendered
+            if key in self.running:
+                return
+            self.seq += 1
+            self.pending[key] = self.seq
+            heapq.heappush(self.queue, (priority, self.seq, key, func))
+            self.condition.notify()
+
+    def retain(self, keys):
+        """Drop queued jobs whose key is not in keys"""
+        with self.condition:
+            for key in [k for k in self.pending if k not in keys]:
+                del self.pending[key]
+            self.compact()
+
+    def is_idle(self):
+        """Check whether no job is queued or running"""
+        with self.condition:
+            return not self.pending and not self.running
+
+    def clear(self):
+        """Drop all queued jobs, and stop running ones from blocking resubmission"""
+        with self.condition:
+            self.pending = {}
+            self.queue = []
+            self.running = set()
+
+    def compact(self):
+        """Remove stale heap entries once they dominate the queue"""
+        if len(self.queue) > 2 * len(self.pending) + 16:
+            self.queue = [entry for entry in self.queue if self.pending.get(entry[2]) == entry[1]]
+            heapq.heapify(self.queue)
+
+    def worker_loop(self):
+        """Pop and run the highest-priority job that is still wanted"""
+        while True:
+            with self.condition:
+                while True:
+                    while not self.queue:
+                        self.condition.wait()
+                    priority, seq, key, func = heapq.heappop(self.queue)
+
+                    # Skip entries that were replaced or cancelled after being queued
+                    if self.pending.get(key) != seq:
+                        continue
+                    del self.pending[key]
+                    break
+
+            # The page may have scrolled out of view while the job was waiting
+            if not self.is_wanted(key):
+                continue
+
+            with self.condition:
+                self.running.add(key)
+            try:
+                func()
+            except Exception as e:
+                print(f"Error in render job {key}: {e}")
+            finally:
+                with self.condition:
+                    self.running.discard(key)
+
+def zoom_bucket(zoom_level):
+    """Quantize a zoom level so nearly identical zooms share cache entries"""
+    return round(zoom_level, 2)
+
+class PageBitmapCache:
+    """Byte-budgeted LRU cache of rendered page images keyed by (page, zoom bucket)
+
+    Tiles of pages rendered at high zoom share the same budget; they carry a
+    (tx, ty) tile index in their key, while whole pages use tile=None.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (page_num, bucket, tile) -> PIL image, oldest first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(img):
+        """Approximate memory held by a PIL image"""
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, page_num, bucket, tile=None):
+        """Return the cached image for this page (or tile) and zoom bucket, or None"""
+        with self.lock:
+            img = self.entries.get((page_num, bucket, tile))
+            if img is not None:
+                self.entries.move_to_end((page_num, bucket, tile))
+            return img
+
+    def put(self, page_num, bucket, img, tile=None):
+        """Store an image and evict least recently used entries over the budget"""
+        size = self.image_bytes(img)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((page_num, bucket, tile), None)
+            if old is not None:
+                self.total_bytes -= self.image_bytes(old)
+            self.entries[(page_num, bucket, tile)] = img
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self.image_bytes(evicted)
+
+    def nearest(self, page_num, bucket):
+        """Return (bucket, image) for the cached whole-page resolution closest to bucket"""
+        with self.lock:
+            candidates = [b for (p, b, t) in self.entries if p == page_num and t is None]
+            if not candidates:
+                return None
+            # Compare zooms by ratio so 1.0 -> 2.0 counts the same as 2.0 -> 4.0
+            best = min(candidates, key=lambda b: abs(math.log(b / bucket)))
+            return best, self.entries[(page_num, best, None)]
+
+    def clear(self):
+        """Drop every cached image"""
+        with self.lock:
+            self.entries = OrderedDict()
+            self.total_bytes = 0
+
+class SpanIndex:
+    """Text spans of one page in page coordinates, sorted by top edge for range queries
+
+    The index is zoom-independent: callers map their query rectangle into page
+    coordinates instead of the spans being transformed to canvas space.
+    """
+    def __init__(self, text_spans):
+        # Spans keep their extraction (reading) order; span ids are positions in it
+        self.texts = [text for text, bbox in text_spans]
+        self.boxes = np.array([bbox for text, bbox in text_spans], dtype=np.float32).reshape(-1, 4)
+        
+        # Secondary order by top edge, plus the tallest span, bounds the candidates
+        # for a query to one contiguous slice
+        self.by_top = np.argsort(self.boxes[:, 1], kind="stable")
+        self.tops = self.boxes[self.by_top, 1]
+        self.max_height = float((self.boxes[:, 3] - self.boxes[:, 1]).max()) if len(self.texts) else 0.0
+
+    def query(self, x0, y0, x1, y1):
+        """Return ids, in reading order, of the spans intersecting a rectangle"""
+        lo = np.searchsorted(self.tops, y0 - self.max_height, side="left")
+        hi = np.searchsorted(self.tops, y1, side="right")
+        candidates = self.by_top[lo:hi]
+        boxes = self.boxes[candidates]
+        hits = (
+            (boxes[:, 0] <= x1) & (boxes[:, 2] >= x0) &
+            (boxes[:, 1] <= y1) & (boxes[:, 3] >= y0)
+        )
+        return np.sort(candidates[hits])
+
+class DiskRenderCache:
+    """SQLite store of compressed page bitmaps, text spans and page layouts"""
+    BITMAP = "bitmap"
+    TEXT = "text"
+    LAYOUT = "layout"
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(cache_dir, "render_cache.sqlite3"),
+            check_same_thread=False  # Shared by the UI thread and render workers
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                doc_hash TEXT, kind TEXT, page INTEGER, bucket REAL,
+                data BLOB, size INTEGER, last_used REAL,
+                PRIMARY KEY (doc_hash, kind, page, bucket)
+            )"""
+        )
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, doc_hash, kind, page=-1, bucket=-1.0):
+        """Return the raw blob for a key and mark it as recently used"""
+        key = (doc_hash, kind, page, bucket)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM entries WHERE doc_hash=? AND kind=? AND page=? AND bucket=?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE entries SET last_used=? WHERE doc_hash=? AND kind=? AND page=? AND bucket=?",
+                (time.time(),) + key
+            )
+            self.conn.commit()
+            return row[0]
+
+    def put(self, doc_hash, kind, data, page=-1, bucket=-1.0):
+        """Store a blob, evicting least recently used entries over the size cap"""
+        key = (doc_hash, kind, page, bucket)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size FROM entries WHERE doc_hash=? AND kind=? AND page=? AND bucket=?", key
+            ).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (data, len(data), time.time())
+            )
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """Delete the least recently used entries to make room"""
+        self.total_bytes = evict_lru(
+            self.conn, "entries", ("doc_hash", "kind", "page", "bucket"), "size",
+            self.total_bytes, self.max_bytes
+        )
+
+    def get_bitmap(self, doc_hash, page_num, bucket):
+        """Load a cached page bitmap as a PIL image"""
+        data = self.get(doc_hash, self.BITMAP, page_num, bucket)
+        if data is None:
+            return None
+        width, height = struct.unpack("<II", data[:8])
+        return Image.frombytes("RGB", (width, height), zlib.decompress(data[8:]))
+
+    def put_bitmap(self, doc_hash, page_num, bucket, img):
+        """Store a page bitmap as zlib-compressed RGB samples"""
+        data = struct.pack("<II", img.width, img.height) + zlib.compress(img.tobytes(), 1)
+        self.put(doc_hash, self.BITMAP, data, page_num, bucket)
+
+    def get_json(self, doc_hash, kind, page_num=-1):
+        """Load a cached JSON value (text spans or page layout)"""
+        data = self.get(doc_hash, kind, page_num)
+        if data is None:
+            return None
+        return json.loads(zlib.decompress(data))
+
+    def put_json(self, doc_hash, kind, value, page_num=-1):
+        """Store a JSON value compressed"""
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        self.put(doc_hash, kind, data, page_num)
+
 class PDFViewer:
-    def __init__(self, root, pdf_path=None):
+    def __init__(self, root, pdf_path=None, bitmap_cache_mb=256, cache_dir=None, disk_cache_mb=512):
         self.root = root
         self.root.title("Research Paper Viewer")
         self.root.geometry("1000x900")  # Increased width to accommodate the notes panel
@@ -32,8 +316,13 @@ class PDFViewer:
         self.selected_text = ""
         self.selection_start = None
         self.selection_end = None
-        self.text_instances = []  # Will store text block positions
-        self.highlighted_areas = []  # Will store canvas rectangles for highlights
+        self.selecting = False  # The mouse button is down on a selection drag
+        self.page_span_index = {}  # page_num -> SpanIndex of its text spans in page coordinates
+        self.highlighted_areas = []  # Will store canvas rectangles for highlights of earlier selections
+        self.current_highlights = {}  # (page_num, span_id) -> highlight rectangle of the current drag
+        self.selection_update_pending = False  # A selection update is queued for idle time
+        self.idle_text_pending = False  # A check for idle text-layer work is scheduled
+        self.source_boxes = None  # (page_num, boxes) of the RAG source shown by show_source
         
         # Add multi-selection variables
         self.is_appending = False  # Track if we're appending to selection (Ctrl pressed)
@@ -41,13 +330,76 @@ class PDFViewer:
         
         # Variables for efficient continuous scrolling
         self.visible_page_range = 3  # Number of pages to keep in memory (current + adjacent pages)
-        self.page_positions = []     # Store y-positions of each page
-        self.page_heights = []       # Store heights of each page
+        # Page layout at the current zoom, as NumPy arrays indexed by page number
+        self.page_positions = np.zeros(0)  # Store y-positions of each page
+        self.page_heights = np.zeros(0)    # Store heights of each page
+        self.page_bottoms = np.zeros(0)    # y-position of the bottom edge of each page
+        self.page_widths = np.zeros(0)     # Store widths of each page
+        self.total_height = 0.0            # Height of the whole document on the canvas
         self.current_visible_pages = set()  # Currently rendered pages
         self.previously_visible_pages = set()  # Pages that were visible in the last render
-        self.last_scroll_pos = 0.0   # Last scroll position for detection of scroll direction
+        self.last_scroll_pos = 0.0   # Canvas y of the view at the last wheel-triggered render update
         self.is_rendering = False    # Flag to prevent multiple simultaneous renders
         
+        # Rendered bitmaps: photo_images holds the Tk images shown for the visible
+        # pages, while bitmap_cache keeps recently rendered pages at every zoom level
+        # so going back to a page or zoom is instant.
+        self.photo_images = {}       # page_num -> ImageTk.PhotoImage currently displayed
+        self.preview_pages = set()   # Pages showing a rescaled bitmap from another zoom
+        self.bitmap_cache = PageBitmapCache(max_bytes=bitmap_cache_mb * 1024 * 1024)
+        
+        # Tiled rendering: pages bigger than max_full_page_pixels at the current
+        # zoom are rasterized as tile_size squares, and only the tiles that
+        # intersect the viewport are rendered
+        self.tile_size = 512
+        self.max_full_page_pixels = 4_000_000
+        self.tile_photos = {}        # (page_num, tx, ty) -> ImageTk.PhotoImage currently displayed
+        self.preview_tiles = set()   # Tiles showing a crop of a lower-resolution page bitmap
+        self.wanted_tiles = set()    # (page_num, zoom_level, tx, ty) of tiles in the viewport
+        self.render_pending = False  # A render was requested while is_rendering was set
+        
+        # Progressive rendering: a page with nothing cached first gets a cheap
+        # preview at preview_scale of the zoom, replaced by the full render later
+        self.preview_scale = 0.3
+        
+        # Persistent canvas layout: placeholders are built once per zoom level and
+        # render passes only add or remove the image items that changed
+        self.layout_zoom = None      # Zoom level the placeholders were built for
+        self.page_image_items = {}   # page_num -> PhotoImage currently drawn on the canvas
+        self.drawn_tiles = {}        # (page_num, tx, ty) -> PhotoImage currently drawn
+        
+        # Predictive prefetch: scroll speed and direction decide how many pages
+        # beyond the view get rendered into bitmap_cache ahead of time
+        self.scroll_velocity = 0.0       # Smoothed scroll speed in canvas pixels/second (+ = down)
+        self.scroll_direction = 1        # Direction of the last movement (1 = down, -1 = up)
+        self.last_scroll_sample = None   # (time, canvas y) of the previous scroll movement
+        self.prefetch_horizon = 1.0      # Seconds of travel to render ahead
+        self.max_prefetch_pages = 8      # Never prefetch more than this many pages
+        self.prefetch_budget = 0.5       # Fraction of the bitmap cache prefetching may fill
+        self.prefetch_pages = set()      # Pages currently scheduled for prefetch
+        
+        # Optional on-disk cache of bitmaps, text and page sizes keyed by the
+        # PDF's content hash, so reopening a paper skips MuPDF entirely
+        self.disk_cache = None
+        self.doc_hash = None
+        self.doc_generation = 0  # Bumped whenever a new document replaces self.doc
+        self.page_sizes = np.zeros((0, 2))  # Unzoomed (width, height) of every page
+        if cache_dir:
+            try:
+                self.disk_cache = DiskRenderCache(cache_dir, max_bytes=disk_cache_mb * 1024 * 1024)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Disk cache disabled: {e}")
+
+        # Background rendering: a small worker pool instead of one thread per page.
+        # MuPDF documents are not thread-safe, so all access to self.doc from the
+        # workers goes through doc_lock.
+        self.render_workers = 2
+        self.doc_lock = threading.Lock()
+        self.render_scheduler = RenderScheduler(
+            num_workers=self.render_workers,
+            is_wanted=self.is_render_wanted
+        )
+
         # Frame for controls
         self.control_frame = tk.Frame(root)
         self.control_frame.pack(side=tk.BOTTOM, fill=tk.X)
@@ -118,7 +470,7 @@ class PDFViewer:
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         # Scrollbar
-        self.scrollbar = tk.Scrollbar(self.canvas_frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.scrollbar = tk.Scrollbar(self.canvas_frame, orient=tk.VERTICAL, command=self.on_scrollbar)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.canvas.configure(yscrollcommand=self.scrollbar.set)
         
@@ -156,21 +508,36 @@ class PDFViewer:
     def load_pdf(self, pdf_path):
         """Load a PDF file and display the first page"""
         try:
-            self.doc = fitz.open(pdf_path)
-            self.total_pages = len(self.doc)
+            doc = fitz.open(pdf_path)
+            doc_hash = hash_file(pdf_path) if self.disk_cache else None
+            
+            # Drop render jobs for the previous document and invalidate the ones
+            # still running before swapping documents; their results are discarded
+            self.render_scheduler.clear()
+            self.doc_generation += 1
+            with self.doc_lock:
+                self.doc = doc
+                self.doc_hash = doc_hash
+                self.total_pages = len(doc)
             self.current_page = 0
             self.root.title(f"Research Paper Viewer - {pdf_path}")
             
+            self.bitmap_cache.clear()
+            self.clear_displayed_images()
+            self.page_span_index = {}
+            self.source_boxes = None
+            
             # Reset page tracking variables
-            self.page_positions = []
-            self.page_heights = []
+            self.page_positions = np.zeros(0)
+            self.page_heights = np.zeros(0)
             self.current_visible_pages = set()
             
             # Update slider range
             self.page_slider.configure(to=self.total_pages)
             self.page_slider.set(1)  # Set to first page
             
-            # Pre-calculate page heights at current zoom level
+            # Read page sizes once, then pre-calculate page heights at current zoom level
+            self.load_page_sizes()
             self.precalculate_page_heights()
             
             self.update_page_label()
@@ -188,51 +555,54 @@ class PDFViewer:
         if pdf_path:
             self.load_pdf(pdf_path)
     
+    def load_page_sizes(self):
+        """Read the unzoomed size of every page, from the disk cache when possible"""
+        if self.disk_cache and self.doc_hash:
+            page_sizes = self.disk_cache.get_json(self.doc_hash, DiskRenderCache.LAYOUT)
+            if page_sizes is not None and len(page_sizes) == self.total_pages:
+                self.page_sizes = np.array(page_sizes, dtype=float).reshape(-1, 2)
+                return
+        
+        page_sizes = []
+        for page_num in range(self.total_pages):
+            page_rect = self.doc[page_num].rect
+            page_sizes.append((page_rect.width, page_rect.height))
+        self.page_sizes = np.array(page_sizes, dtype=float).reshape(-1, 2)
+        
+        if self.disk_cache and self.doc_hash:
+            self.disk_cache.put_json(self.doc_hash, DiskRenderCache.LAYOUT, page_sizes)
+    
     def precalculate_page_heights(self):
-        """Pre-calculate heights of all pages at current zoom level"""
-        if not self.doc:
+        """Pre-calculate sizes and positions of all pages at current zoom level"""
+        if not self.doc or len(self.page_sizes) == 0:
             return
-            
-        self.page_heights = []
-        self.page_positions = [0]  # First page starts at position 0
         
-        total_height = 0
+        # Scale every page at once; no fitz pages are touched here
+        self.page_widths = self.page_sizes[:, 0] * self.zoom_level
+        self.page_heights = self.page_sizes[:, 1] * self.zoom_level
         
-        # Calculate heights and positions for each page without actually rendering
-        for page_num in range(self.total_pages):
-            page = self.doc[page_num]
-            
-            # Get page dimensions and calculate height based on aspect ratio
-            page_rect = page.rect
-            width = page_rect.width * self.zoom_level
-            height = page_rect.height * self.zoom_level
-            
-            self.page_heights.append(height)
-            
-            # Calculate position of next page
-            total_height += height + self.page_spacing
-            if page_num < self.total_pages - 1:
-                self.page_positions.append(total_height)
+        # Each page starts where the previous one ended plus the spacing
+        self.page_bottoms = np.cumsum(self.page_heights + self.page_spacing) - self.page_spacing
+        self.page_positions = self.page_bottoms - self.page_heights
+        self.total_height = float(self.page_bottoms[-1])
     
     def render_page(self):
         """Render visible pages based on current scroll position"""
         if not self.doc:
             return
             
-        # Prevent multiple simultaneous renders
+        # Prevent multiple simultaneous renders, but remember the request so the
+        # final scroll position still gets rendered
         if self.is_rendering:
+            self.render_pending = True
             return
             
         self.is_rendering = True
+        self.render_pending = False
         
-        # Clear canvas and reset text selection if not appending
-        self.canvas.delete("all")
-        self.text_instances = []
-        if not self.is_appending:
-            self.selected_text = ""
-            self.previous_selections = []
-            self.update_selection_label()
-            self.update_text_display()
+        # Placeholders only change with the zoom level (or a new document)
+        if self.layout_zoom != self.zoom_level:
+            self.build_layout()
         
         # Determine which pages should be visible
         self.update_visible_pages()
@@ -240,32 +610,118 @@ class PDFViewer:
         # Get the zoom matrix
         zoom_matrix = fitz.Matrix(self.zoom_level, self.zoom_level)
         
-        # Calculate total height needed for all pages
-        if not self.page_heights:  # If heights haven't been calculated yet
-            self.precalculate_page_heights()
-            
-        total_height = self.page_positions[-1] + self.page_heights[-1] if self.page_heights else 0
+        # Define the pages to render (both visible and the closest 3)
+        pages_to_render = self.current_visible_pages
         
-        # Get visible region
-        visible_top = self.canvas.canvasy(0)
-        visible_bottom = visible_top + self.canvas.winfo_height()
+        # Prioritize rendering order:
+        # 1. Current page
+        # 2. One page before and one page after current
+        # 3. Other visible pages
+        render_order = sorted(pages_to_render, key=lambda x: abs(x - self.current_page))
         
-        # Create placeholders for all pages
-        max_width = 0
-        for page_num in range(self.total_pages):
-            page = self.doc[page_num]
-            page_rect = page.rect
-            width = page_rect.width * self.zoom_level
-            max_width = max(max_width, width)
+        # Work out which tiles of high-zoom pages intersect the viewport
+        self.update_wanted_tiles(render_order)
+        
+        # Pick the pages to render ahead in the direction of travel
+        self.prefetch_pages = set(self.plan_prefetch(render_order))
+        
+        # Cancel queued jobs for pages and tiles that have left the view
+        wanted_jobs = {(page_num, self.zoom_level) for page_num in render_order}
+        wanted_jobs |= {("text", page_num) for page_num in render_order}
+        wanted_jobs |= {("preview", page_num, self.zoom_level) for page_num in render_order}
+        wanted_jobs |= {("prefetch", page_num, self.zoom_level) for page_num in self.prefetch_pages}
+        self.render_scheduler.retain(wanted_jobs | self.wanted_tiles)
+        
+        # Remove the image items of pages that left the view
+        for page_num in list(self.page_image_items):
+            if page_num not in pages_to_render or page_num not in self.photo_images:
+                self.canvas.delete(f"page_image_{page_num}")
+                del self.page_image_items[page_num]
+        
+        # Render visible pages and closest 3 pages regardless of visibility
+        for page_num in render_order:
+            # Large pages are drawn tile by tile instead of as one bitmap
+            if self.is_tiled(page_num):
+                # Tiles borrow their previews from a cached page bitmap
+                if self.bitmap_cache.nearest(page_num, zoom_bucket(self.zoom_level)) is None:
+                    self.request_preview(page_num)
+                self.render_page_tiles(page_num, zoom_matrix)
+                continue
             
-            # Create page boundaries for all pages that are part of the document
-            y_offset = self.page_positions[page_num]
-            height = self.page_heights[page_num]
+            # Pull the page from the bitmap cache, or a rescaled preview of it
+            if page_num not in self.photo_images:
+                self.load_page_from_cache(page_num)
             
+            # Nothing cached at any zoom: get something on screen fast
+            if page_num not in self.photo_images:
+                self.request_preview(page_num)
+            
+            # Check if we already have this page rendered and cached
+            if page_num in self.photo_images:
+                # If already cached, display it unless that image is already on the canvas
+                if self.page_image_items.get(page_num) is not self.photo_images[page_num]:
+                    self.draw_page_image(page_num)
+            
+            if page_num in self.photo_images and page_num not in self.preview_pages:
+                continue
+            else:
+                # If not cached, queue it for the render workers, nearest pages first
+                self.render_scheduler.submit(
+                    (page_num, self.zoom_level),
+                    (PRIORITY_RENDER, abs(page_num - self.current_page)),
+                    lambda page_num=page_num, zoom_level=self.zoom_level, state=self.document_state():
+                        self.render_page_in_background(state, page_num, zoom_matrix, zoom_level)
+                )
+        
+        # Render prefetched pages into the bitmap cache after the pages in view
+        bucket = zoom_bucket(self.zoom_level)
+        for page_num in self.prefetch_pages:
+            if self.bitmap_cache.get(page_num, bucket) is None:
+                self.render_scheduler.submit(
+                    ("prefetch", page_num, self.zoom_level),
+                    (PRIORITY_PREFETCH, abs(page_num - self.current_page)),
+                    lambda page_num=page_num, zoom_level=self.zoom_level, state=self.document_state():
+                        self.render_page_in_background(state, page_num, zoom_matrix, zoom_level)
+                )
+        
+        # Prefetch text layers once the renders are done; see queue_idle_text_layers
+        if not self.idle_text_pending:
+            self.idle_text_pending = True
+            self.root.after_idle(self.queue_idle_text_layers)
+        
+        # Reset rendering flag after a short delay to prevent too frequent updates
+        self.root.after(100, self.reset_rendering_flag)
+    
+    def build_layout(self):
+        """Create the page placeholders and scrollregion for the current zoom level"""
+        self.canvas.delete("all")
+        self.page_image_items = {}
+        self.drawn_tiles = {}
+        
+        # Highlights were deleted with the canvas; reset text selection if not appending.
+        # A drag in progress ends too, since its canvas coordinates are for the old zoom.
+        self.highlighted_areas = []
+        self.current_highlights = {}
+        self.selecting = False
+        if not self.is_appending:
+            self.selected_text = ""
+            self.previous_selections = []
+            self.update_selection_label()
+            self.update_text_display()
+        
+        # Calculate total height needed for all pages
+        if len(self.page_heights) != self.total_pages:  # If heights haven't been calculated yet
+            self.precalculate_page_heights()
+        if self.total_pages == 0:
+            return
+        
+        # Create placeholders for all pages
+        layout = zip(self.page_positions.tolist(), self.page_widths.tolist(), self.page_heights.tolist())
+        for page_num, (y_offset, width, height) in enumerate(layout):
             # Create a white rectangle for ALL pages in the document
             self.canvas.create_rectangle(
-                0, y_offset, max_width, y_offset + height,
-                fill="white", outline="#CCCCCC"
+                0, y_offset, width, y_offset + height,
+                fill="white", outline="#CCCCCC", tags="placeholder"
             )
             
             # Add page number as text to ALL pages
@@ -273,144 +729,491 @@ class PDFViewer:
                 10, y_offset + 10, 
                 text=f"Page {page_num + 1}", 
                 fill="#888888", 
-                anchor="nw"
+                anchor="nw",
+                tags="placeholder"
             )
-            
-            # Draw a separator line after each page (except the last one)
-            # if page_num < self.total_pages - 1:
-            #     separator_y = y_offset + height + self.page_spacing // 2
-            #     self.canvas.create_line(
-            #         0, separator_y, max_width, separator_y,
-            #         fill="#CCCCCC", width=2
-            #     )
         
         # Set scrollregion to the size of the entire document
-        self.canvas.config(scrollregion=(0, 0, max_width, total_height))
-        
-        # Define the pages to render (both visible and the closest 3)
-        pages_to_render = self.current_visible_pages
-        
-        # Prioritize rendering order:
-        # 1. Current page
-        # 2. One page before and one page after current
-        # 3. Other visible pages
-        render_order = sorted(pages_to_render, key=lambda x: abs(x - self.current_page))
-        
-        # Render visible pages and closest 3 pages regardless of visibility
-        for page_num in render_order:
-            # Check if we already have this page rendered and cached
-            if hasattr(self, 'photo_images') and page_num in self.photo_images:
-                # If already cached, just display it on the canvas
-                y_offset = self.page_positions[page_num]
-                self.canvas.create_image(0, y_offset, anchor=tk.NW, image=self.photo_images[page_num])
-                
-                # If the page has text blocks already extracted, add them
-                if hasattr(self, 'page_text_blocks') and page_num in self.page_text_blocks:
-                    for text_block in self.page_text_blocks[page_num]:
-                        self.text_instances.append(text_block)
-            else:
-                # If not cached, render in background thread
-                threading.Thread(
-                    target=self.render_page_in_background,
-                    args=(page_num, zoom_matrix),
-                    daemon=True
-                ).start()
+        self.canvas.config(scrollregion=(0, 0, float(self.page_widths.max()), self.total_height))
+        self.layout_zoom = self.zoom_level
+        self.draw_source_highlights()
+    
+    def draw_page_image(self, page_num):
+        """Place a page's image on the canvas, replacing any earlier version"""
+        self.canvas.delete(f"page_image_{page_num}")
+        self.canvas.create_image(
+            0, self.page_positions[page_num], anchor=tk.NW, image=self.photo_images[page_num],
+            tags=("page_image", f"page_image_{page_num}")
+        )
+        self.page_image_items[page_num] = self.photo_images[page_num]
+        self.canvas.tag_raise("highlight")
+    
+    def plan_prefetch(self, visible_pages):
+        """Return the pages to render ahead of the view, nearest first"""
+        if not visible_pages:
+            return []
+        
+        # A stale velocity means the user stopped; still prefetch one page in the
+        # direction they were last going
+        speed = 0.0
+        if self.last_scroll_sample and time.monotonic() - self.last_scroll_sample[0] < 0.5:
+            speed = abs(self.scroll_velocity)
+        average_height = self.total_height / self.total_pages
+        count = min(self.max_prefetch_pages, 1 + int(speed * self.prefetch_horizon / average_height))
+        
+        if self.scroll_direction > 0:
+            edge = max(visible_pages)
+        else:
+            edge = min(visible_pages)
+        
+        # Stop at the memory budget; prefetched bitmaps only live in bitmap_cache
+        budget = self.bitmap_cache.max_bytes * self.prefetch_budget
+        pages = []
+        for step in range(1, count + 1):
+            page_num = edge + step * self.scroll_direction
+            if page_num < 0 or page_num >= self.total_pages or self.is_tiled(page_num):
+                break
+            cost = self.page_widths[page_num] * self.page_heights[page_num] * 3
+            if cost > budget:
+                break
+            budget -= cost
+            pages.append(page_num)
+        return pages
+    
+    def record_scroll_motion(self):
+        """Update the smoothed scroll velocity and direction from the current view"""
+        now = time.monotonic()
+        position = self.canvas.canvasy(0)
+        
+        if self.last_scroll_sample is not None:
+            last_time, last_position = self.last_scroll_sample
+            elapsed = now - last_time
+            if elapsed > 0.5:
+                # Long pause: start measuring afresh
+                self.scroll_velocity = 0.0
+            elif elapsed > 0:
+                instant_velocity = (position - last_position) / elapsed
+                self.scroll_velocity = 0.5 * self.scroll_velocity + 0.5 * instant_velocity
+            
+            if position != last_position:
+                self.scroll_direction = 1 if position > last_position else -1
         
-        # Reset rendering flag after a short delay to prevent too frequent updates
-        self.root.after(100, self.reset_rendering_flag)
+        self.last_scroll_sample = (now, position)
     
     def reset_rendering_flag(self):
         """Reset the rendering flag to allow new renders"""
         self.is_rendering = False
+        if self.render_pending:
+            self.render_page()
+    
+    def is_render_wanted(self, key):
+        """Check from a worker thread whether a queued render job is still needed"""
+        if key[0] == "text":
+            return key[1] not in self.page_span_index
+        if key[0] == "preview":
+            return key[2] == self.zoom_level and key[1] in self.current_visible_pages
+        if key[0] == "prefetch":
+            return key[2] == self.zoom_level and key[1] in self.prefetch_pages
+        if len(key) == 4:
+            return key in self.wanted_tiles
+        page_num, zoom_level = key
+        return zoom_level == self.zoom_level and page_num in self.current_visible_pages
+    
+    def document_state(self):
+        """Snapshot the open document for a render job queued now"""
+        return DocumentState(self.doc, self.doc_hash, self.doc_generation)
     
-    def render_page_in_background(self, page_num, zoom_matrix):
-        """Render a single page in the background thread"""
+    def is_current(self, state):
+        """Check whether a render job's document is still the one on screen"""
+        return state.generation == self.doc_generation
+    
+    def render_page_in_background(self, state, page_num, zoom_matrix, zoom_level):
+        """Render a single page on a render worker thread"""
         try:
-            # Get page position
-            y_offset = self.page_positions[page_num]
+            if not self.is_current(state):
+                return
+            bucket = zoom_bucket(zoom_level)
             
-            # Render the page (we'll always render pages in visible_pages set)
-            page = self.doc[page_num]
-            
-            # Render the page at the correct aspect ratio
-            pix = page.get_pixmap(matrix=zoom_matrix)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+            # Try the disk cache first; a hit needs no MuPDF work at all
+            img = None
+            if self.disk_cache and state.doc_hash:
+                img = self.disk_cache.get_bitmap(state.doc_hash, page_num, bucket)
             
-            # Extract text information
-            text_page = page.get_text("dict")
-            text_blocks = []
-            
-            # Process text blocks
-            if 'blocks' in text_page:
-                for block in text_page['blocks']:
-                    if 'lines' not in block:
-                        continue
-                        
-                    for line in block['lines']:
-                        if 'spans' not in line:
-                            continue
-                            
-                        for span in line['spans']:
-                            if 'text' not in span or not span['text'].strip():
-                                continue
-                            
-                            # Get text and its rectangle coords
-                            text = span['text']
-                            bbox = span['bbox']
-                            
-                            # Apply zoom
-                            x0, y0, x1, y1 = bbox
-                            x0 *= self.zoom_level
-                            y0 *= self.zoom_level
-                            x1 *= self.zoom_level
-                            y1 *= self.zoom_level
-                            
-                            # Adjust for page position
-                            y0 += y_offset
-                            y1 += y_offset
-                            
-                            # Store text with its position
-                            text_blocks.append({
-                                'text': text,
-                                'bbox': (x0, y0, x1, y1)
-                            })
+            if img is None:
+                img = self.rasterize(state.doc, page_num, zoom_matrix)
+                if self.disk_cache and state.doc_hash:
+                    self.disk_cache.put_bitmap(state.doc_hash, page_num, bucket, img)
             
             # Use tkinter's after method to safely update the UI from the main thread
-            self.root.after(0, lambda: self.update_canvas_with_page(page_num, img, text_blocks, y_offset))
+            self.root.after(0, lambda: self.update_canvas_with_page(page_num, img, zoom_level, state.generation))
             
         except Exception as e:
             print(f"Error rendering page {page_num}: {e}")
     
-    def update_canvas_with_page(self, page_num, img, text_blocks, y_offset):
+    def request_preview(self, page_num):
+        """Queue a low-resolution first pass for a page, ahead of all full renders"""
+        self.render_scheduler.submit(
+            ("preview", page_num, self.zoom_level),
+            (PRIORITY_PREVIEW, abs(page_num - self.current_page)),
+            lambda zoom_level=self.zoom_level, state=self.document_state():
+                self.render_preview_in_background(state, page_num, zoom_level)
+        )
+    
+    def render_preview_in_background(self, state, page_num, zoom_level):
+        """Render a cheap low-resolution preview of a page on a render worker thread"""
+        try:
+            if not self.is_current(state):
+                return
+            
+            # A full-quality bitmap on disk is cheaper than any preview
+            if self.disk_cache and state.doc_hash and not self.is_tiled(page_num):
+                img = self.disk_cache.get_bitmap(state.doc_hash, page_num, zoom_bucket(zoom_level))
+                if img is not None:
+                    self.root.after(0, lambda: self.update_canvas_with_page(page_num, img, zoom_level, state.generation))
+                    return
+            
+            # Keep the preview small even when the page itself is tiled
+            width, height = self.page_sizes[page_num]
+            preview_zoom = zoom_level * self.preview_scale
+            max_zoom = math.sqrt(self.max_full_page_pixels / 4 / (width * height))
+            preview_zoom = min(preview_zoom, max_zoom)
+            
+            img = self.rasterize(state.doc, page_num, fitz.Matrix(preview_zoom, preview_zoom))
+            self.root.after(0, lambda: self.update_canvas_with_preview(page_num, img, preview_zoom, zoom_level, state.generation))
+            
+        except Exception as e:
+            print(f"Error rendering preview of page {page_num}: {e}")
+    
+    def render_tile_in_background(self, state, page_num, tx, ty, zoom_matrix, zoom_level):
+        """Render one tile of a page on a render worker thread"""
+        try:
+            if not self.is_current(state):
+                return
+            
+            # Clip rectangle of the tile in unzoomed page coordinates
+            page_width, page_height = self.page_sizes[page_num]
+            step = self.tile_size / zoom_level
+            clip = fitz.Rect(
+                tx * step, ty * step,
+                min((tx + 1) * step, page_width), min((ty + 1) * step, page_height)
+            )
+            img = self.rasterize(state.doc, page_num, zoom_matrix, clip)
+            self.root.after(0, lambda: self.update_canvas_with_tile(page_num, tx, ty, img, zoom_level, state.generation))
+            
+        except Exception as e:
+            print(f"Error rendering tile {tx},{ty} of page {page_num}: {e}")
+    
+    def load_text_layer_in_background(self, state, page_num):
+        """Load a page's text layer on a render worker thread"""
+        try:
+            if not self.is_current(state):
+                return
+            text_spans = self.load_text_spans(state, page_num)
+            self.root.after(0, lambda: self.update_text_layer(page_num, text_spans, state.generation))
+        except Exception as e:
+            print(f"Error extracting text from page {page_num}: {e}")
+    
+    def queue_idle_text_layers(self):
+        """Prefetch the text layers of the pages in view while the render workers are idle
+        
+        Extraction holds doc_lock like rasterization, so a text job that is
+        already running would delay the next render. Only a job per worker is
+        queued at a time, and only when no render is queued or running.
+        """
+        self.idle_text_pending = False
+        if not self.doc:
+            return
+        missing = sorted(
+            (p for p in self.current_visible_pages if p not in self.page_span_index),
+            key=lambda p: abs(p - self.current_page)
+        )
+        if not missing:
+            return
+        if self.render_scheduler.is_idle():
+            self.request_text_layers(missing[:self.render_workers], PRIORITY_IDLE_TEXT)
+        
+        # Come back for the rest, or once the renders have finished
+        self.idle_text_pending = True
+        self.root.after(100, self.queue_idle_text_layers)
+    
+    def request_text_layers(self, pages, band):
+        """Queue text extraction for the pages that don't have a text layer yet"""
+        for page_num in pages:
+            if page_num not in self.page_span_index:
+                self.render_scheduler.submit(
+                    ("text", page_num),
+                    (band, abs(page_num - self.current_page)),
+                    lambda page_num=page_num, state=self.document_state():
+                        self.load_text_layer_in_background(state, page_num)
+                )
+    
+    def update_text_layer(self, page_num, text_spans, generation):
+        """Index a page's text spans (called from the main thread)"""
+        # Text extracted from a document that has since been replaced
+        if generation != self.doc_generation:
+            return
+        
+        self.page_span_index[page_num] = SpanIndex(text_spans)
+        
+        # A drag that started before the text arrived can now select it
+        if self.selecting and self.selection_start and self.selection_end:
+            self.update_selection()
+    
+    def rasterize(self, doc, page_num, zoom_matrix, clip=None):
+        """Rasterize a page, or only the clip rectangle of it, to a PIL image"""
+        with self.doc_lock:
+            # Render the page at the correct aspect ratio
+            pix = doc[page_num].get_pixmap(matrix=zoom_matrix, clip=clip)
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    
+    def load_text_spans(self, state, page_num):
+        """Get a page's text spans from the disk cache, extracting them if missing"""
+        if self.disk_cache and state.doc_hash:
+            text_spans = self.disk_cache.get_json(state.doc_hash, DiskRenderCache.TEXT, page_num)
+            if text_spans is not None:
+                return [(text, tuple(bbox)) for text, bbox in text_spans]
+        
+        text_spans = self.extract_text_spans(state.doc, page_num)
+        if self.disk_cache and state.doc_hash:
+            self.disk_cache.put_json(state.doc_hash, DiskRenderCache.TEXT, text_spans, page_num)
+        return text_spans
+    
+    def extract_text_spans(self, doc, page_num):
+        """Extract (text, bbox) for every non-empty span of a page with MuPDF"""
+        with self.doc_lock:
+            # Extract text information
+            text_page = doc[page_num].get_text("dict")
+        
+        text_spans = []
+        
+        # Process text blocks
+        if 'blocks' in text_page:
+            for block in text_page['blocks']:
+                if 'lines' not in block:
+                    continue
+                    
+                for line in block['lines']:
+                    if 'spans' not in line:
+                        continue
+                        
+                    for span in line['spans']:
+                        if 'text' not in span or not span['text'].strip():
+                            continue
+                        
+                        # Store text with its unzoomed page rectangle, so the
+                        # spans stay valid across zoom changes
+                        text_spans.append((span['text'], tuple(span['bbox'])))
+        
+        return text_spans
+    
+    def update_canvas_with_page(self, page_num, img, zoom_level, generation):
         """Update the canvas with a rendered page (called from the main thread)"""
+        # Rendered from a document that has since been replaced
+        if generation != self.doc_generation:
+            return
+        
+        # Keep the bitmap even if it is no longer needed right now; scrolling or
+        # zooming back to it will then be instant
+        self.bitmap_cache.put(page_num, zoom_bucket(zoom_level), img)
+        
         # Only continue if the page is still part of visible pages
         if page_num not in self.current_visible_pages:
             return
-            
+        
+        # Discard renders that finished after the zoom level changed
+        if zoom_level != self.zoom_level:
+            return
+        
         # Create a PhotoImage and keep a reference to prevent garbage collection
-        if not hasattr(self, 'photo_images'):
-            self.photo_images = {}
-            
-        # Store the image
         self.photo_images[page_num] = ImageTk.PhotoImage(image=img)
+        self.preview_pages.discard(page_num)
         
-        # Create text blocks storage if it doesn't exist
-        if not hasattr(self, 'page_text_blocks'):
-            self.page_text_blocks = {}
+        # Replace any preview of this page, then display the sharp render
+        self.draw_page_image(page_num)
+    
+    def update_canvas_with_preview(self, page_num, img, preview_zoom, zoom_level, generation):
+        """Show a low-resolution preview until the full render arrives (main thread)"""
+        if generation != self.doc_generation:
+            return
+        
+        # Cached like any other resolution, so later zooms can borrow it too
+        self.bitmap_cache.put(page_num, zoom_bucket(preview_zoom), img)
+        
+        if page_num not in self.current_visible_pages or zoom_level != self.zoom_level:
+            return
+        
+        if self.is_tiled(page_num):
+            # Fill the tiles that are still blank with crops of the preview
+            for key in sorted(k for k in self.wanted_tiles if k[0] == page_num):
+                _, _, tx, ty = key
+                if (page_num, tx, ty) not in self.tile_photos:
+                    self.load_tile_preview(page_num, tx, ty)
+                    if (page_num, tx, ty) in self.tile_photos:
+                        self.draw_tile(page_num, tx, ty)
+            return
+        
+        # Never replace a full-quality render that beat the preview
+        if page_num in self.photo_images and page_num not in self.preview_pages:
+            return
+        self.load_page_from_cache(page_num)
+        if page_num in self.photo_images:
+            self.draw_page_image(page_num)
+    
+    def update_canvas_with_tile(self, page_num, tx, ty, img, zoom_level, generation):
+        """Update the canvas with a rendered tile (called from the main thread)"""
+        if generation != self.doc_generation:
+            return
+        
+        self.bitmap_cache.put(page_num, zoom_bucket(zoom_level), img, tile=(tx, ty))
+        
+        # Only display tiles that are still in the viewport at the current zoom
+        if (page_num, zoom_level, tx, ty) not in self.wanted_tiles:
+            return
+        
+        self.tile_photos[(page_num, tx, ty)] = ImageTk.PhotoImage(image=img)
+        self.preview_tiles.discard((page_num, tx, ty))
+        self.draw_tile(page_num, tx, ty)
+    
+    def clear_displayed_images(self):
+        """Release the Tk images of all displayed pages and tiles"""
+        self.photo_images = {}
+        self.preview_pages = set()
+        self.tile_photos = {}
+        self.preview_tiles = set()
+        self.wanted_tiles = set()
+        
+        # Force the placeholders to be rebuilt on the next render pass
+        self.layout_zoom = None
+    
+    def is_tiled(self, page_num):
+        """Check whether a page is too large at the current zoom to render in one piece"""
+        width, height = self.page_sizes[page_num]
+        return width * height * self.zoom_level ** 2 > self.max_full_page_pixels
+    
+    def visible_tiles(self, page_num):
+        """Return (tx, ty) for the tiles of a page that intersect the viewport"""
+        # Viewport in canvas coordinates, padded by half a tile so small scrolls
+        # don't uncover blank tiles
+        margin = self.tile_size // 2
+        left = self.canvas.canvasx(0) - margin
+        top = self.canvas.canvasy(0) - margin
+        right = left + self.canvas.winfo_width() + 2 * margin
+        bottom = top + self.canvas.winfo_height() + 2 * margin
+        
+        # Intersect with the page, in page pixel coordinates
+        y_offset = self.page_positions[page_num]
+        width = self.page_widths[page_num]
+        height = self.page_heights[page_num]
+        x0, x1 = max(0, left), min(width, right)
+        y0, y1 = max(0, top - y_offset), min(height, bottom - y_offset)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        
+        size = self.tile_size
+        return [
+            (tx, ty)
+            for ty in range(int(y0 // size), int(math.ceil(y1 / size)))
+            for tx in range(int(x0 // size), int(math.ceil(x1 / size)))
+        ]
+    
+    def update_wanted_tiles(self, pages):
+        """Recompute which tiles should be on screen and release the others"""
+        self.wanted_tiles = set()
+        for page_num in pages:
+            if self.is_tiled(page_num):
+                for tx, ty in self.visible_tiles(page_num):
+                    self.wanted_tiles.add((page_num, self.zoom_level, tx, ty))
+        
+        for key in list(self.tile_photos):
+            page_num, tx, ty = key
+            if (page_num, self.zoom_level, tx, ty) not in self.wanted_tiles:
+                del self.tile_photos[key]
+                self.preview_tiles.discard(key)
+                self.drawn_tiles.pop(key, None)
+                self.canvas.delete(f"tile_{page_num}_{tx}_{ty}")
+    
+    def render_page_tiles(self, page_num, zoom_matrix):
+        """Display the cached tiles of a page in view and queue the missing ones"""
+        bucket = zoom_bucket(self.zoom_level)
+        for key in sorted(k for k in self.wanted_tiles if k[0] == page_num):
+            _, zoom_level, tx, ty = key
+            tile_key = (page_num, tx, ty)
             
-        # Store text blocks for this page
-        self.page_text_blocks[page_num] = text_blocks
+            if tile_key not in self.tile_photos or tile_key in self.preview_tiles:
+                img = self.bitmap_cache.get(page_num, bucket, tile=(tx, ty))
+                if img is not None:
+                    self.tile_photos[tile_key] = ImageTk.PhotoImage(image=img)
+                    self.preview_tiles.discard(tile_key)
+                else:
+                    if tile_key not in self.tile_photos:
+                        self.load_tile_preview(page_num, tx, ty)
+                    self.render_scheduler.submit(
+                        key,
+                        (PRIORITY_RENDER, abs(page_num - self.current_page)),
+                        lambda page_num=page_num, tx=tx, ty=ty, zoom_level=zoom_level, state=self.document_state():
+                            self.render_tile_in_background(state, page_num, tx, ty, zoom_matrix, zoom_level)
+                    )
+            
+            if tile_key in self.tile_photos and self.drawn_tiles.get(tile_key) is not self.tile_photos[tile_key]:
+                self.draw_tile(page_num, tx, ty)
+    
+    def load_tile_preview(self, page_num, tx, ty):
+        """Show a crop of the nearest cached page bitmap in place of a missing tile"""
+        nearest = self.bitmap_cache.nearest(page_num, zoom_bucket(self.zoom_level))
+        if nearest is None:
+            return
+        
+        _, img = nearest
+        page_width = self.page_widths[page_num]
+        page_height = self.page_heights[page_num]
+        size = self.tile_size
+        x0, y0 = tx * size, ty * size
+        x1, y1 = min(x0 + size, page_width), min(y0 + size, page_height)
+        
+        # Map the tile rectangle onto the cached bitmap and scale the crop up
+        scale = img.width / page_width
+        crop = img.crop((int(x0 * scale), int(y0 * scale), int(math.ceil(x1 * scale)), int(math.ceil(y1 * scale))))
+        preview = crop.resize((max(1, int(x1 - x0)), max(1, int(y1 - y0))), Image.BILINEAR)
+        self.tile_photos[(page_num, tx, ty)] = ImageTk.PhotoImage(image=preview)
+        self.preview_tiles.add((page_num, tx, ty))
+    
+    def draw_tile(self, page_num, tx, ty):
+        """Place a tile's image on the canvas, replacing any earlier version"""
+        tag = f"tile_{page_num}_{tx}_{ty}"
+        self.canvas.delete(tag)
+        self.canvas.create_image(
+            tx * self.tile_size, self.page_positions[page_num] + ty * self.tile_size,
+            anchor=tk.NW, image=self.tile_photos[(page_num, tx, ty)],
+            tags=("page_image", f"page_image_{page_num}", tag)
+        )
+        self.drawn_tiles[(page_num, tx, ty)] = self.tile_photos[(page_num, tx, ty)]
+        self.canvas.tag_raise("highlight")
+    
+    def load_page_from_cache(self, page_num):
+        """Show a cached bitmap for a page, rescaling the nearest zoom if needed"""
+        bucket = zoom_bucket(self.zoom_level)
+        img = self.bitmap_cache.get(page_num, bucket)
+        if img is not None:
+            self.photo_images[page_num] = ImageTk.PhotoImage(image=img)
+            self.preview_pages.discard(page_num)
+            return
         
-        # Always display the page on the canvas (since it's in visible_pages)
-        self.canvas.create_image(0, y_offset, anchor=tk.NW, image=self.photo_images[page_num])
+        nearest = self.bitmap_cache.nearest(page_num, bucket)
+        if nearest is None:
+            return
         
-        # Add text blocks to the text_instances list
-        for text_block in text_blocks:
-            self.text_instances.append(text_block)
+        # Stretch the closest resolution to the current page size as a stand-in
+        # until the sharp render arrives
+        _, img = nearest
+        height = max(1, int(self.page_heights[page_num]))
+        width = max(1, int(img.width * height / img.height))
+        preview = img.resize((width, height), Image.BILINEAR)
+        self.photo_images[page_num] = ImageTk.PhotoImage(image=preview)
+        self.preview_pages.add(page_num)
     
     def update_visible_pages(self):
         """Determine which pages should be visible based on scroll position"""
-        if not self.doc or not self.page_positions:
+        if not self.doc or len(self.page_positions) == 0:
             return
             
         # Get current view position (what's visible in the canvas)
@@ -429,15 +1232,12 @@ class PDFViewer:
             # Update slider without triggering the callback
             self.page_slider.set(self.current_page + 1)
         
-        # Calculate range for visible pages based on what's actually in view
-        visible_pages = set()
-        for page_num in range(self.total_pages):
-            y_offset = self.page_positions[page_num]
-            height = self.page_heights[page_num]
-            
-            # Check if this page is visible or partially visible
-            if not (y_offset > view_bottom or y_offset + height < view_top):
-                visible_pages.add(page_num)
+        # Calculate range for visible pages based on what's actually in view: the
+        # first page whose bottom is below view_top up to the last page whose top
+        # is above view_bottom
+        first_visible = int(np.searchsorted(self.page_bottoms, view_top, side="left"))
+        last_visible = int(np.searchsorted(self.page_positions, view_bottom, side="right"))
+        visible_pages = set(range(first_visible, last_visible))
         
         # Always include the 3 closest pages centered on current_page
         closest_pages = set(range(
@@ -453,37 +1253,22 @@ class PDFViewer:
             # Store the current visible pages
             self.current_visible_pages = new_visible_pages
             
-            # Identify pages that need to be unloaded
-            if hasattr(self, 'photo_images'):
-                keys_to_remove = [k for k in self.photo_images.keys() if k not in new_visible_pages]
-                for k in keys_to_remove:
-                    del self.photo_images[k]
+            # Release the Tk images of pages that left the view; their bitmaps
+            # stay in bitmap_cache
+            keys_to_remove = [k for k in self.photo_images.keys() if k not in new_visible_pages]
+            for k in keys_to_remove:
+                del self.photo_images[k]
+                self.preview_pages.discard(k)
     
     def find_page_at_position(self, y_position):
         """Find which page contains the given y-position"""
-        if not self.page_positions:
+        if len(self.page_positions) == 0:
             return 0
-            
-        # Binary search to find the page
-        left = 0
-        right = len(self.page_positions) - 1
         
-        while left <= right:
-            mid = (left + right) // 2
-            
-            # Check if position is on this page
-            page_top = self.page_positions[mid]
-            page_bottom = page_top + self.page_heights[mid]
-            
-            if page_top <= y_position < page_bottom:
-                return mid
-            elif y_position < page_top:
-                right = mid - 1
-            else:
-                left = mid + 1
-                
-        # If not found directly, return the closest page
-        return min(max(0, left), self.total_pages - 1)
+        # Binary search for the first page whose bottom edge is below the
+        # position; positions in the gap after a page map to the next page
+        page_num = int(np.searchsorted(self.page_bottoms, y_position, side="right"))
+        return min(max(0, page_num), self.total_pages - 1)
     
     def on_page_slider_change(self, event):
         """Handle page slider change"""
@@ -498,17 +1283,14 @@ class PDFViewer:
     
     def scroll_to_page(self, page_num):
         """Scroll to show the specified page"""
-        if not self.doc or not self.page_positions or page_num < 0 or page_num >= self.total_pages:
+        if not self.doc or len(self.page_positions) == 0 or page_num < 0 or page_num >= self.total_pages:
             return
             
         # Calculate position to scroll to (the top of the page)
         y_pos = self.page_positions[page_num]
         
-        # Get total height of document
-        total_height = self.page_positions[-1] + self.page_heights[-1]
-        
         # Scroll to position
-        self.canvas.yview_moveto(y_pos / total_height)
+        self.canvas.yview_moveto(y_pos / self.total_height)
         
         # Update current page
         self.current_page = page_num
@@ -521,6 +1303,40 @@ class PDFViewer:
         self.update_visible_pages()
         self.render_page()
     
+    def show_source(self, page, boxes):
+        """Jump to a RAG source chunk and outline its text blocks.
+        
+        page is 1-based and boxes are (x0, y0, x1, y1) in PDF points, as stored in
+        a chunk's metadata, so no text search is needed to find the passage.
+        """
+        page_num = page - 1
+        if not self.doc or page_num < 0 or page_num >= self.total_pages:
+            return
+        self.source_boxes = (page_num, [tuple(box) for box in boxes])
+        self.scroll_to_page(page_num)
+        
+        # Bring the first block into view rather than the top of the page
+        if boxes:
+            y_pos = self.page_positions[page_num] + boxes[0][1] * self.zoom_level - 40
+            self.canvas.yview_moveto(max(y_pos, 0) / self.total_height)
+            self.update_visible_pages()
+            self.render_page()
+        self.draw_source_highlights()
+    
+    def draw_source_highlights(self):
+        """Draw the outlines of the source shown by show_source at the current zoom"""
+        self.canvas.delete("source_highlight")
+        if not self.source_boxes or len(self.page_positions) != self.total_pages:
+            return
+        page_num, boxes = self.source_boxes
+        y_offset = self.page_positions[page_num]
+        zoom = self.zoom_level
+        for x0, y0, x1, y1 in boxes:
+            self.canvas.create_rectangle(
+                x0 * zoom - 2, y0 * zoom + y_offset - 2, x1 * zoom + 2, y1 * zoom + y_offset + 2,
+                outline="#1E90FF", width=2, tags=("highlight", "source_highlight")
+            )
+    
     def ctrl_pressed(self, event):
         """Handle Ctrl key press for multi-selection"""
         self.is_appending = True
@@ -544,10 +1360,18 @@ class PDFViewer:
             # If appending, save current selection before starting a new one
             if self.selected_text:
                 self.previous_selections.append(self.selected_text)
+            
+            # Keep the finished selection's highlights; the new drag starts empty
+            self.highlighted_areas.extend(self.current_highlights.values())
+            self.current_highlights = {}
         
         self.selection_start = (canvas_x, canvas_y)
         self.selection_end = None
+        self.selecting = True
         self.update_selection_label()
+        
+        # Make sure the pages in view have a text layer, ahead of any rendering
+        self.request_text_layers(self.current_visible_pages, PRIORITY_SELECTION_TEXT)
     
     def on_mouse_drag(self, event):
         """Handle mouse drag for text selection"""
@@ -556,7 +1380,12 @@ class PDFViewer:
             canvas_x = self.canvas.canvasx(event.x)
             canvas_y = self.canvas.canvasy(event.y)
             self.selection_end = (canvas_x, canvas_y)
-            self.update_selection()
+            
+            # Motion events can arrive faster than the screen refreshes; fold
+            # them into one selection update per idle cycle
+            if not self.selection_update_pending:
+                self.selection_update_pending = True
+                self.root.after_idle(self.update_selection)
     
     def on_mouse_up(self, event):
         """Handle mouse button release for text selection"""
@@ -566,9 +1395,11 @@ class PDFViewer:
             canvas_y = self.canvas.canvasy(event.y)
             self.selection_end = (canvas_x, canvas_y)
             self.update_selection()
+        self.selecting = False
     
     def update_selection(self):
         """Update text selection based on mouse position"""
+        self.selection_update_pending = False
         if not self.selection_start or not self.selection_end:
             return
             
@@ -582,38 +1413,52 @@ class PDFViewer:
         if y1 > y2:
             y1, y2 = y2, y1
         
-        selection_rect = (x1, y1, x2, y2)
         selected_texts = []
+        selected_spans = set()
         current_selection = ""
+        zoom = self.zoom_level
         
-        # If we're not clearing previous selections, don't clear highlights
-        if not self.is_appending:
-            self.clear_highlights()
+        # Only pages overlapping the selection vertically can contain hits
+        first_page = int(np.searchsorted(self.page_bottoms, y1, side="left"))
+        last_page = int(np.searchsorted(self.page_positions, y2, side="right"))
         
-        # Check which text blocks intersect with the selection rectangle
-        for text_obj in self.text_instances:
-            text = text_obj['text']
-            bbox = text_obj['bbox']
+        # Query each page's span index with the selection mapped into page coordinates
+        for page_num in range(first_page, last_page):
+            index = self.page_span_index.get(page_num)
+            if index is None:
+                continue
             
-            # Check for intersection
-            if self.rectangles_intersect(selection_rect, bbox):
-                selected_texts.append(text)
-                
-                # Use different highlight colors for multi-selection
-                highlight_color = "#FF7F50" # Default color
-                outline_color = "#FF4500"   # Default outline
-                
-                if self.is_appending:
-                    # Use a different color for appended selections
-                    highlight_color = "#90EE90"  # Light green
-                    outline_color = "#32CD32"    # Lime green
-                
-                # Highlight the selected text
-                highlight = self.canvas.create_rectangle(
-                    bbox[0], bbox[1], bbox[2], bbox[3],
-                    fill=highlight_color, outline=outline_color, stipple="gray25"
-                )
-                self.highlighted_areas.append(highlight)
+            y_offset = self.page_positions[page_num]
+            for span_id in index.query(x1 / zoom, (y1 - y_offset) / zoom, x2 / zoom, (y2 - y_offset) / zoom):
+                selected_texts.append(index.texts[span_id])
+                selected_spans.add((page_num, int(span_id)))
+        
+        # Only touch the highlights whose state changed since the last update
+        for key in [k for k in self.current_highlights if k not in selected_spans]:
+            self.canvas.delete(self.current_highlights.pop(key))
+        
+        # Use different highlight colors for multi-selection
+        highlight_color = "#FF7F50" # Default color
+        outline_color = "#FF4500"   # Default outline
+        
+        if self.is_appending:
+            # Use a different color for appended selections
+            highlight_color = "#90EE90"  # Light green
+            outline_color = "#32CD32"    # Lime green
+        
+        for page_num, span_id in selected_spans:
+            if (page_num, span_id) in self.current_highlights:
+                continue
+            
+            # Highlight the selected text, mapping its box back to canvas coordinates
+            y_offset = self.page_positions[page_num]
+            bx0, by0, bx1, by1 = self.page_span_index[page_num].boxes[span_id].tolist()
+            highlight = self.canvas.create_rectangle(
+                bx0 * zoom, by0 * zoom + y_offset, bx1 * zoom, by1 * zoom + y_offset,
+                fill=highlight_color, outline=outline_color, stipple="gray25",
+                tags="highlight"
+            )
+            self.current_highlights[(page_num, span_id)] = highlight
         
         # Join all selected text with spaces
         current_selection = " ".join(selected_texts)
@@ -628,26 +1473,14 @@ class PDFViewer:
         self.update_selection_label()
         self.update_text_display()
     
-    def rectangles_intersect(self, rect1, rect2):
-        """Check if two rectangles intersect"""
-        x1_1, y1_1, x2_1, y2_1 = rect1
-        x1_2, y1_2, x2_2, y2_2 = rect2
-        
-        # Check if one rectangle is on the left side of the other
-        if x2_1 < x1_2 or x2_2 < x1_1:
-            return False
-            
-        # Check if one rectangle is above the other
-        if y2_1 < y1_2 or y2_2 < y1_1:
-            return False
-            
-        return True
-    
     def clear_highlights(self):
         """Clear all highlighted text areas"""
         for highlight in self.highlighted_areas:
             self.canvas.delete(highlight)
+        for highlight in self.current_highlights.values():
+            self.canvas.delete(highlight)
         self.highlighted_areas = []
+        self.current_highlights = {}
     
     def update_selection_label(self):
         """Update the selection label with selected text info"""
@@ -692,9 +1525,8 @@ class PDFViewer:
             # Remember current page
             current_page = self.current_page
             
-            # Clear photo image cache
-            if hasattr(self, 'photo_images'):
-                self.photo_images = {}
+            # Drop the displayed images; bitmap_cache keeps them for previews
+            self.clear_displayed_images()
             
             # Recalculate page heights and positions
             self.precalculate_page_heights()
@@ -721,26 +1553,60 @@ class PDFViewer:
         # Adjust scroll speed
         scroll_units = 2  # Increased for better scrolling speed
         self.canvas.yview_scroll(scroll_amount * scroll_units, "units")
-        
-        # Store current scroll position
-        current_pos = self.canvas.yview()[0]  # Get top position as fraction
-        
-        # Check if we need to update page rendering
-        if abs(current_pos - self.last_scroll_pos) > 0.03:  # Threshold to reduce frequency
-            self.last_scroll_pos = current_pos
-            
-            # Cancel any pending updates to avoid redundant rendering
-            if hasattr(self, 'after_id'):
-                try:
-                    self.root.after_cancel(self.after_id)
-                except:
-                    pass
-                    
-            # Schedule a new update
-            self.after_id = self.root.after(50, self.delayed_render_update)
+        self.record_scroll_motion()
+        
+        # Check if we need to update page rendering. Tiled pages need an update
+        # on every scroll, since any movement can uncover new tiles.
+        tiled = self.doc is not None and self.is_tiled(self.current_page)
+        if tiled or self.needs_render_update():
+            self.last_scroll_pos = self.canvas.canvasy(0)
+            self.schedule_render_update()
             
         return "break"  # Prevent event propagation
     
+    def needs_render_update(self):
+        """Check whether the view moved far enough to need a render pass"""
+        if not self.doc or len(self.page_positions) == 0:
+            return False
+        
+        view_top = self.canvas.canvasy(0)
+        view_height = self.canvas.winfo_height()
+        view_bottom = view_top + view_height
+        
+        # Half a screen of movement, measured in pixels so the threshold does not
+        # grow with the length of the document
+        if abs(view_top - self.last_scroll_pos) > view_height / 2:
+            return True
+        
+        # Less than a screen left before the end of the rendered and prefetched pages
+        covered = self.current_visible_pages | self.prefetch_pages
+        if not covered:
+            return True
+        first, last = min(covered), max(covered)
+        if first > 0 and view_top - view_height < self.page_positions[first]:
+            return True
+        if last < self.total_pages - 1 and view_bottom + view_height > self.page_bottoms[last]:
+            return True
+        return False
+    
+    def schedule_render_update(self):
+        """Debounce render updates triggered by scrolling or panning"""
+        # Cancel any pending updates to avoid redundant rendering
+        if hasattr(self, 'after_id'):
+            try:
+                self.root.after_cancel(self.after_id)
+            except:
+                pass
+                
+        # Schedule a new update
+        self.after_id = self.root.after(50, self.delayed_render_update)
+    
+    def on_scrollbar(self, *args):
+        """Scroll from the scrollbar and render the pages brought into view"""
+        self.canvas.yview(*args)
+        self.record_scroll_motion()
+        self.schedule_render_update()
+    
     def delayed_render_update(self):
         """Update visible pages and render with a slight delay to prevent too frequent updates"""
         self.update_visible_pages()
@@ -753,6 +1619,12 @@ class PDFViewer:
     def scroll_move(self, event):
         """Move/pan canvas with middle mouse button"""
         self.canvas.scan_dragto(event.x, event.y, gain=1)
+        
+        self.record_scroll_motion()
+        
+        # Panning at high zoom brings new tiles into view
+        if self.doc and self.is_tiled(self.current_page):
+            self.schedule_render_update()
     
     def prev_page(self):
         """Go to previous page - now handled by slider and scrolling"""
@@ -783,9 +1655,8 @@ class PDFViewer:
             # Reset rendering flag
             self.is_rendering = False
             
-            # Clear photo image cache completely when zooming
-            if hasattr(self, 'photo_images'):
-                self.photo_images = {}
+            # Drop the displayed images; bitmap_cache keeps them for previews
+            self.clear_displayed_images()
             
             # Recalculate page heights and positions
             self.precalculate_page_heights()
@@ -807,9 +1678,8 @@ class PDFViewer:
             # Reset rendering flag
             self.is_rendering = False
             
-            # Clear photo image cache completely when zooming
-            if hasattr(self, 'photo_images'):
-                self.photo_images = {}
+            # Drop the displayed images; bitmap_cache keeps them for previews
+            self.clear_displayed_images()
             
             # Recalculate page heights and positions
             self.precalculate_page_heights()
@@ -834,7 +1704,13 @@ def main():
     if len(sys.argv) > 1:
         pdf_path = sys.argv[1]
     
-    app = PDFViewer(root, pdf_path)
+    app = PDFViewer(root, pdf_path, cache_dir=DEFAULT_CACHE_DIR)
+    
+    # Optionally open at a RAG source chunk: viewer.py paper.pdf PAGE [x0,y0,x1,y1 ...]
+    if len(sys.argv) > 2:
+        page = int(sys.argv[2])
+        boxes = [tuple(float(v) for v in arg.split(",")) for arg in sys.argv[3:]]
+        root.after_idle(lambda: app.show_source(page, boxes))
     root.mainloop()
 
 if __name__ == "__main__":
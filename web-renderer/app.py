@@ -1,9 +1,33 @@
 import os
-from flask import Flask, send_from_directory, render_template, request, jsonify
+import sys
+import threading
+from flask import Flask, send_from_directory, render_template, request, jsonify, Response, stream_with_context
 import glob
 
+# rag.py lives at the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 app = Flask(__name__)
 
+# One RAG service shared by every request, started on the first question
+rag_service = None
+rag_service_lock = threading.Lock()
+
+def get_rag_service():
+    """Start the shared RAG service on first use, indexing the PDFs this app serves"""
+    global rag_service
+    with rag_service_lock:
+        if rag_service is None:
+            api_key = os.environ.get('GOOGLE_API_KEY')
+            if not api_key:
+                raise RuntimeError("Set GOOGLE_API_KEY to enable questions")
+            from rag import RAGSystem, RAGService
+            rag = RAGSystem(api_key)
+            rag.add_directory(os.path.join(os.path.dirname(__file__), 'pdfs'))
+            rag_service = RAGService(rag)
+            rag_service.start()
+    return rag_service
+
 @app.route('/')
 def index():
     return render_template('viewer.html')
@@ -26,6 +50,37 @@ def handle_selection():
     print(f"Selected text: {selected_text}")
     return jsonify({"status": "success"})
 
+@app.route('/api/ask', methods=['POST'])
+def ask():
+    """Answer a question about the served PDFs; set "stream" to get the text as it is generated"""
+    data = request.json or {}
+    question = data.get('question', '').strip()
+    if not question:
+        return jsonify({"error": "question is required"}), 400
+    try:
+        service = get_rag_service()
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    
+    try:
+        k = int(data.get('k', 5))
+    except (TypeError, ValueError):
+        k = 0
+    if k < 1:
+        return jsonify({"error": "k must be a positive integer"}), 400
+    
+    options = {"k": k, "sources": data.get('sources') or None}
+    try:
+        if data.get('stream'):
+            # Resolve sources before the response starts, so a bad one is still a 404
+            if options["sources"]:
+                service.rag.resolve_documents(options["sources"])
+            return Response(stream_with_context(service.stream_sync(question, **options)),
+                            mimetype='text/plain')
+        return jsonify(service.ask_sync(question, **options))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+
 if __name__ == '__main__':
     # Create necessary directories
     os.makedirs(os.path.join(os.path.dirname(__file__), 'templates'), exist_ok=True)